@@ -1,12 +1,40 @@
+import os
 import sys
 import ConfigParser
 
 def configure():
     config = ConfigParser.SafeConfigParser()
+    # Workers started by the daemon are pointed at the file it read
+    path = os.environ.get('DRUPALDAEMONS_CNF', sys.path[0] + '/drupaldaemons.cnf')
     try:
-        config.readfp(open(sys.path[0] + '/drupaldaemons.cnf'))
+        config.readfp(open(path))
     except IOError:
-        config.readfp(open("/etc/drupaldaemons.cnf"))
+        path = "/etc/drupaldaemons.cnf"
+        config.readfp(open(path))
+    config.path = os.path.abspath(path)
     return config
 
+def option(section, name, default):
+    """Read an optional setting, cast to the type of its default."""
+    if not config.has_option(section, name):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, name)
+    elif isinstance(default, int):
+        return config.getint(section, name)
+    elif isinstance(default, float):
+        return config.getfloat(section, name)
+    else:
+        return config.get(section, name)
+
+def shared_option(section, name, default):
+    """Read a limit which applies across all the worker processes, and
+    return the share of it each worker enforces (at least 1). 0, no limit,
+    is returned as it is."""
+    value = option(section, name, default)
+    workers = option('drupalSSHGitServer', 'workers', 0)
+    if value and workers > 1:
+        return max(1, value // workers)
+    return value
+
 config = configure()
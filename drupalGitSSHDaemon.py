@@ -4,19 +4,23 @@ epollreactor.install()
 
 import os
 import shlex
+import signal
+import struct
 import sys
+import time
 from twisted.conch.avatar import ConchUser
-from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.error import CannotListenError, ProcessExitedAlready
 from twisted.conch.error import ConchError, UnauthorizedLogin, ValidPublicKey
 from twisted.conch.ssh.channel import SSHChannel
+from twisted.conch.ssh.connection import SSHConnection
 from twisted.conch.ssh.session import ISession, SSHSession, SSHSessionProcessProtocol
 from twisted.conch.ssh.factory import SSHFactory
+from twisted.conch.ssh.transport import SSHServerTransport
 from twisted.conch.ssh.keys import Key
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword, ISSHPrivateKey
 from twisted.cred.portal import IRealm, Portal
-from twisted.internet import reactor, defer
-from twisted.internet.defer import DeferredList
+from twisted.internet import reactor, defer, stdio
 from twisted.python import components, log
 from twisted.python.failure import Failure
 from zope import interface
@@ -29,21 +33,83 @@ SSHSessionProcessProtocol.outConnectionLost = lambda self: None
 import urllib
 import base64
 import hashlib
-import json
+import hmac
 
-from config import config
+from config import config, option, shared_option
 from service import Service
-from service.protocols import AuthProtocol
-from drupalpass import DrupalHash
+from service.authdata import AuthData
+from service.cache import ResponseCache, PolledResponse, CacheControlFactory
+from service.limiter import BackendUnavailable
+from service.protocols import AuthProtocol, backend_limiter
+from drupalpass import deferHash
+from gitssh.admission import ProcessLimiter
+from gitssh.metrics import registry, timed, MetricsSite, SIZE_BUCKETS
+from gitssh.packcache import PackCache, CachingUploadPack
+from gitssh.pktline import format_git_error
+from gitssh.refcache import RefCache, AdvertisedUploadPack
+from gitssh.repoindex import RepositoryIndex
+from gitssh.spawner import Spawner
+from gitssh.workers import WorkerMaster, drain
+
+phase_seconds = registry.histogram('gitssh_phase_seconds',
+    'Time taken by each phase of logging in and running a session.', ['phase'])
+channel_bytes = registry.histogram('gitssh_channel_bytes',
+    'Bytes sent and received on each session channel.', ['direction'],
+    buckets=SIZE_BUCKETS)
+open_sessions = registry.gauge('gitssh_sessions', 'Session channels open.')
 
 class DrupalMeta(object):
     def __init__(self):
         self.anonymousReadAccess = config.getboolean('drupalSSHGitServer', 'anonymousReadAccess')
+        self.deferUserKeyCheck = option('drupalSSHGitServer', 'deferUserKeyCheck', False)
+        # Seconds past the ttl that auth data is still used for, while it is
+        # refreshed or the auth service is down
+        self.read_max_stale = option('auth-cache', 'readMaxStale', 3600)
+        self.push_max_stale = option('auth-cache', 'pushMaxStale', 300)
+        self.auth_cache = ResponseCache(option('auth-cache', 'ttl', 60),
+                                        option('auth-cache', 'maxSize', 2000),
+                                        max(self.read_max_stale, self.push_max_stale))
+        # The push control mask is global, so it is polled in the background
+        # rather than requested for every session. Polling starts with the
+        # GitServer factory.
+        self.pushctl = PolledResponse(self.pushctl_request,
+                                      option('drupalSSHGitServer', 'pushctlInterval', 30))
+        # Repository paths for each scheme, and the repositories under them
+        self.scheme_paths = dict((section, config.get(section, 'repositoryPath'))
+                                 for section in config.sections()
+                                 if config.has_option(section, 'repositoryPath'))
+        self.repositories = None
+        if option('repository-index', 'enabled', True):
+            # Started with the GitServer factory
+            self.repositories = RepositoryIndex(self.scheme_paths.values(),
+                                                option('repository-index', 'rescanInterval', 300),
+                                                option('repository-index', 'negativeTTL', 10))
+        # Responses to full clones, loaded with the GitServer factory
+        self.packs = None
+        if option('pack-cache', 'enabled', False):
+            megabyte = 1024 * 1024
+            self.packs = PackCache(config.get('pack-cache', 'directory'),
+                                   option('pack-cache', 'maxSize', 2048) * megabyte,
+                                   option('pack-cache', 'maxEntrySize', 512) * megabyte)
+        # Ref advertisements of git-upload-pack
+        self.refs = None
+        if option('ref-cache', 'enabled', True):
+            self.refs = RefCache(option('ref-cache', 'maxSize', 64) * 1024 * 1024)
+        # Starts git processes, started with the GitServer factory
+        self.spawner = None
+        if option('git-processes', 'spawner', True):
+            self.spawner = Spawner()
+
+    def pushctl_request(self):
+        pushctl_service = Service(AuthProtocol('pushctl-state'))
+        pushctl_service.request_json()
+        return pushctl_service.deferred
 
-    def request(self, uri):
+    @timed(phase_seconds, phase='request')
+    def request(self, uri, push=False):
         """Build the request to run against drupal
 
-        request(project uri)
+        request(project uri, whether the session is a push)
 
         Values and structure returned:
         {username: {uid:int, 
@@ -61,34 +127,44 @@ class DrupalMeta(object):
                     ssh_keys: { key_name:fingerprint }
                    }
         }"""
-        auth_service = Service(AuthProtocol('vcs-auth-data'))
-        auth_service.request_json({"project_uri":self.projectname(uri)})
-        pushctl_service= Service(AuthProtocol('pushctl-state'))
-        pushctl_service.request_json()
+        project = self.projectname(uri)
+        def fetch():
+            auth_service = Service(AuthProtocol('vcs-auth-data'))
+            auth_service.request_json({"project_uri":project})
+            auth_service.addCallback(
+                lambda result: AuthData(result) if isinstance(result, dict) else result)
+            return auth_service.deferred
+        max_stale = self.push_max_stale if push else self.read_max_stale
+        auth_deferred = self.auth_cache.get(project, fetch, max_stale)
         def NoDataHandler(fail):
             fail.trap(ConchError)
+            if fail.check(BackendUnavailable):
+                # Tell the client, rather than that it has no access
+                return fail
             message = fail.value.value
             log.err(message)
             # Return a stub auth_service object
-            return {"users":{}, "repo_id":None}
-        auth_service.addErrback(NoDataHandler)
-        return DeferredList([auth_service.deferred, pushctl_service.deferred])
+            return AuthData({"users":{}, "repo_id":None})
+        auth_deferred.addErrback(NoDataHandler)
+        return auth_deferred
 
     def repopath(self, scheme, subpath):
         '''Note, this is where we do further mapping into a subdirectory
         for a user or issue's specific sandbox'''
 
-        # Build the path to the repository
-        try:
-            scheme_path = config.get(scheme, 'repositoryPath')
-        except:
-            # Fall back to the default configured path scheme
-            scheme_path = config.get('drupalSSHGitServer', 'repositoryPath')
+        # Build the path to the repository, falling back to the default
+        # configured path scheme
+        scheme_path = self.scheme_paths.get(scheme,
+                                            self.scheme_paths['drupalSSHGitServer'])
         path = os.path.join(scheme_path, *subpath)
         if path[-4:] != ".git":
             path += ".git"
         # Check to see that the folder exists
-        if not os.path.exists(path):
+        if self.repositories:
+            exists = self.repositories.exists(path)
+        else:
+            exists = os.path.exists(path)
+        if not exists:
             return None
         return path
 
@@ -102,24 +178,19 @@ class DrupalMeta(object):
         else:
             return project
 
-def find_error_script():
-    for directory in sys.path:
-        full_path = os.path.join(directory, "git-error")
-        if (os.path.exists(full_path) and 
-            os.access(full_path, (os.F_OK | os.X_OK))):
-            return full_path
-    raise Exception('Could not find git-error executable!')
+# Commands a session may run, as git-shell allows them
+GIT_COMMANDS = ('git-upload-pack', 'git-receive-pack', 'git-upload-archive')
 
-def find_git_shell():
-    # Find git-shell path.
+def find_git_command(name):
+    # Find a git command's path.
     # Adapted from http://bugs.python.org/file15381/shutil_which.patch
     path = os.environ.get("PATH", os.defpath)
     for dir in path.split(os.pathsep):
-        full_path = os.path.join(dir, 'git-shell')
+        full_path = os.path.join(dir, name)
         if (os.path.exists(full_path) and 
                 os.access(full_path, (os.F_OK | os.X_OK))):
             return full_path
-    raise Exception('Could not find git executable!')
+    raise Exception('Could not find {0} executable!'.format(name))
 
 class GitSession(object):
     interface.implements(ISession)
@@ -127,63 +198,48 @@ class GitSession(object):
     def __init__(self, user):
         self.user = user
 
-    def map_user(self, username, fingerprint, users):
+    def map_user(self, username, fingerprint, auth_service):
         """Map the username from name or fingerprint, to users item."""
+        users = auth_service["users"]
         if username == "git":
-            # Use the fingerprint
-            for user in users.values():
-                if fingerprint in user["ssh_keys"].values():
-                    return user
-            # No fingerprints match
-            return None
+            # Use the fingerprint, or None if no fingerprints match
+            return auth_service.fingerprints.get(fingerprint)
         elif username in users:
             # Use the username
             return users[username]
         else:
             return None
 
-    def pushcontrol(self, deferred_results, argv):
-        auth_result, pushctl_result = deferred_results
-        auth_status, auth_service = auth_result
-        pushctl_status, pushctl_service = pushctl_result
+    @timed(phase_seconds, phase='pushcontrol')
+    def pushcontrol(self, auth_service, argv):
         if not auth_service:
             error = "Repository does not exist. Verify that your remote is correct."
             raise ConchError(error)
-        if pushctl_status and auth_status:
-            mask = auth_service["repo_group"] & pushctl_service
-            if mask:
-                error = "Pushes for this type of repo are currently disabled."
-                # This type of repo has pushes disabled
-                if mask & 0x01:
-                    error = "Pushes to core are currently disabled."
-                if mask & 0x02:
-                    error = "Pushes to projects are currently disabled."
-                if mask & 0x04:
-                    error = "Pushes to sandboxes are currently disabled."
-                return Failure(ConchError(error))
-            else:
-                # Good to continue with auth
-                return auth_service
-        elif not auth_status:
-            # This will be a failure, not the auth data in this case
+        if 'git-receive-pack' not in argv[:-1]:
+            # Push control only stops pushes; reads go ahead whatever its state
             return auth_service
+        pushctl_state = self.user.meta.pushctl.value
+        if pushctl_state is None:
+            # The push control state has not been read yet
+            error = "This operation cannot be completed at this time.  It may be that we are experiencing technical difficulties or are currently undergoing maintenance."
+            return Failure(ConchError(error))
+        mask = auth_service["repo_group"] & pushctl_state
+        if mask:
+            error = "Pushes for this type of repo are currently disabled."
+            # This type of repo has pushes disabled
+            if mask & 0x01:
+                error = "Pushes to core are currently disabled."
+            if mask & 0x02:
+                error = "Pushes to projects are currently disabled."
+            if mask & 0x04:
+                error = "Pushes to sandboxes are currently disabled."
+            return Failure(ConchError(error))
         else:
-            return pushctl_service
-
-    def auth(self, auth_service, argv):
-        """Verify we have permission to run the request command."""
-        # Key fingerprint
-        if hasattr(self.user.meta, "fingerprint"):
-            fingerprint = self.user.meta.fingerprint
-        else:
-            fingerprint = None
-
-        if hasattr(self.user.meta, "password"):
-            password = self.user.meta.password
-        else:
-            password = None
+            # Good to continue with auth
+            return auth_service
 
-        # Check permissions by mapping requested path to file system path
+    def repository(self, argv):
+        """Map the requested path to the file system path."""
         repostring = argv[-1]
         repolist = repostring.split('/')
         if repolist[0]:
@@ -195,12 +251,19 @@ class GitSession(object):
             projectpath = repolist[2:]
         repopath = self.user.meta.repopath(scheme, projectpath)
         if not repopath:
-            return Failure(ConchError("The remote repository at '{0}' does not exist. Verify that your remote is correct.".format(repostring)))
-        projectname = self.user.meta.projectname(repostring)
+            raise ConchError("The remote repository at '{0}' does not exist. Verify that your remote is correct.".format(repostring))
+        return repopath
+
+    @timed(phase_seconds, phase='auth')
+    def auth(self, auth_service, argv, repopath):
+        """Verify we have permission to run the request command."""
+        # Credentials this connection logged in with
+        fingerprint = self.user.fingerprint
+        password = self.user.password
+        projectname = self.user.meta.projectname(argv[-1])
 
         # Map the user
-        users = auth_service["users"]
-        user = self.map_user(self.user.username, fingerprint, users)
+        user = self.map_user(self.user.username, fingerprint, auth_service)
         execGitCommand = repopath, user, auth_service
 
         # Check to see if anonymous read access is enabled and if
@@ -255,41 +318,82 @@ class GitSession(object):
 
     def errorHandler(self, fail, proto):
         """Catch any unhandled errors and send the exception string to the remote client."""
+        if fail.check(defer.CancelledError):
+            # The channel was closed while waiting, there is no one to tell
+            return
         fail.trap(ConchError)
         message = fail.value.value
         log.err(message)
-        if proto.connectionMade():
-            proto.loseConnection()
-        error_script = self.user.error_script
-        reactor.spawnProcess(proto, error_script, (error_script, message))
+        session = proto.session
+        if session.localClosed:
+            return
+        # Write the error as a git ERR pkt-line, then end the session as a
+        # failed process would
+        session.write(format_git_error(message))
+        session.conn.sendRequest(session, 'exit-status', struct.pack('>L', 1))
+        session.loseConnection()
+
+    def command(self, cmd):
+        """Split the command line, and check it is a git command with one
+        argument, as git-shell would."""
+        try:
+            argv = shlex.split(cmd)
+        except ValueError:
+            argv = []
+        if len(argv) == 3 and argv[0] == 'git':
+            # git upload-pack 'path'
+            argv = ['git-' + argv[1], argv[2]]
+        if len(argv) != 2 or argv[0] not in GIT_COMMANDS:
+            raise ConchError("Unknown command. Only {0} may be run.".format(
+                             ', '.join(GIT_COMMANDS)))
+        return argv
 
     def execCommand(self, proto, cmd):
-        """Execute a git-shell command."""
-        argv = shlex.split(cmd)
-        # This starts an auth request and returns.
+        """Execute a git command."""
         try:
-            auth_service_deferred = self.user.meta.request(argv[-1])
+            argv = self.command(cmd)
+            # Unknown repositories are refused without asking the auth service
+            repopath = self.repository(argv)
+            # This starts an auth request and returns.
+            push = 'git-receive-pack' in argv[:-1]
+            auth_service_deferred = self.user.meta.request(argv[-1], push)
         except ConchError, e:
-            # The request could not be started
+            # The repository does not exist, or the request could not be started
             self.errorHandler(Failure(e), proto)
         else:
             # Check if pushes are disabled for this path
             auth_service_deferred.addCallback(self.pushcontrol, argv)
             # Once it completes, auth is run
-            auth_service_deferred.addCallback(self.auth, argv)
-            # Then the result of auth is passed to execGitCommand to run git-shell
+            auth_service_deferred.addCallback(self.auth, argv, repopath)
+            # Wait until there is room for another git process
+            auth_service_deferred.addCallback(self.admit, argv, proto)
+            # Then the result of auth is passed to execGitCommand to run git
             auth_service_deferred.addCallback(self.execGitCommand, argv, proto)
             auth_service_deferred.addErrback(self.errorHandler, proto)
 
+    @timed(phase_seconds, phase='queue')
+    def admit(self, auth_values, argv, proto):
+        """Wait for the process limiter to allow another git process."""
+        repopath, user, auth_service = auth_values
+        push = 'git-receive-pack' in argv[:-1]
+        uid = user["uid"] if user else None
+        address = proto.session.conn.transport.transport.getPeer().host
+        self.waiting = self.user.processes.acquire(uid, address, push)
+        def admitted(slot):
+            self.slot = slot
+            return auth_values
+        self.waiting.addCallback(admitted)
+        return self.waiting
+
     def execGitCommand(self, auth_values, argv, proto):
-        """After all authentication is done, setup an environment and execute the git-shell commands."""
+        """After all authentication is done, setup an environment and execute the git command."""
         repopath, user, auth_service = auth_values
-        sh = self.user.shell
         repo_id = auth_service["repo_id"]
 
         if proto.session.localClosed:
             # The channel has been closed while we were performing the
             # authentication request, exit.
+            self.slot.release()
             return
 
         env = {}
@@ -299,39 +403,171 @@ class GitSession(object):
             # cast everything we could to integers when loading JSON data
             env['VERSION_CONTROL_GIT_UID'] = str(user["uid"])
             env['VERSION_CONTROL_GIT_REPO_ID'] = str(repo_id)
-            env['VERSION_CONTROL_VCS_AUTH_DATA'] = json.dumps(auth_service)
+            env['VERSION_CONTROL_VCS_AUTH_DATA'] = auth_service.handoff(user)
         
         
-        argv = [str(e) for e in argv]
-        
-        command = ' '.join(argv[:-1] + ["'{0}'".format(repopath)])
-        self.pty = reactor.spawnProcess(proto, sh, (sh, '-c', command), env=env)
+        # The command is run directly, with the repository's path as its
+        # argument, rather than through git-shell
+        command = self.user.commands[argv[0]]
+        args = (argv[0], repopath)
+        upload = 'git-upload-pack' in argv[:-1]
+        def spawn(process):
+            if self.user.meta.packs and upload:
+                # Full clones may be answered from the pack cache
+                process = CachingUploadPack(process, self.user.meta.packs, repopath)
+            if self.user.meta.spawner:
+                self.user.meta.spawner.spawnProcess(process, command, args, env)
+            else:
+                reactor.spawnProcess(process, command, args, env=env)
+        if self.user.meta.refs and upload:
+            # Fetches which want nothing may be answered without a process
+            AdvertisedUploadPack(proto, self.user.meta.refs, repopath, spawn).start()
+        else:
+            spawn(proto)
+        self.started = time.time()
+        # Either the process, or the caches in front of it
+        self.pty = proto.transport
+        self.pty.registerProducer(proto.session, True)
+        proto.session.throttle()
 
     def eofReceived(self):
         if hasattr(self, 'pty'):
             self.pty.closeStdin()
 
     def closed(self):
+        if hasattr(self, 'waiting') and not self.waiting.called:
+            self.waiting.cancel()
         if hasattr(self, 'pty'):
             try:
                 self.pty.signalProcess('HUP')
             except (OSError,ProcessExitedAlready):
                 pass
             self.pty.loseConnection()
+        if hasattr(self, 'slot'):
+            self.slot.release()
+        if hasattr(self, 'started'):
+            phase_seconds.time(self.started, phase='process')
+
+
+class GitSSHSession(SSHSession):
+    """An SSH session channel which may close before it has a process, and
+    which only moves data between the process and the client as fast as the
+    other end takes it.
+
+    The process's output is paused while the client's window is full, or
+    while its connection has too much buffered for the client. The client's
+    window is not opened again while the process's input has too much
+    buffered, for which the session is registered as the producer of the
+    process's input."""
+    def __init__(self, *args, **kwargs):
+        SSHSession.__init__(self, *args, **kwargs)
+        self.sent = 0
+        self.received = 0
+        # Whether the client's window is full
+        self.windowFull = False
+        # Whether the process's output is paused
+        self.paused = False
+        # Whether window adjustments are held back from the client
+        self.holding = False
+        open_sessions.inc()
+
+    def write(self, data):
+        self.sent += len(data)
+        SSHSession.write(self, data)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        SSHSession.dataReceived(self, data)
+
+    def closed(self):
+        SSHSession.closed(self)
+        open_sessions.dec()
+        channel_bytes.observe(self.sent, direction='sent')
+        channel_bytes.observe(self.received, direction='received')
+
+    def loseConnection(self):
+        if self.client and not self.client.transport:
+            # No process was started, e.g. when auth failed
+            SSHChannel.loseConnection(self)
+        else:
+            SSHSession.loseConnection(self)
 
+    # The process's output
 
-class GitConchUser(ConchUser):
-    shell = find_git_shell()
-    error_script = find_error_script()
+    def stopWriting(self):
+        self.windowFull = True
+        self.throttle()
+
+    def startWriting(self):
+        self.windowFull = False
+        self.throttle()
+
+    def throttle(self):
+        """Pause or resume the process's output, as the client keeps up."""
+        paused = self.windowFull or self.conn.congested
+        process = self.client and self.client.transport
+        if not process or paused == self.paused:
+            return
+        self.paused = paused
+        if paused:
+            process.pauseProducing()
+        else:
+            process.resumeProducing()
+
+    # The process's input
+
+    def pauseProducing(self):
+        self.holding = True
 
-    def __init__(self, username, meta):
+    def resumeProducing(self):
+        self.holding = False
+        if self.localWindowLeft < self.localWindowSize // 2:
+            self.conn.adjustWindow(self, self.localWindowSize - self.localWindowLeft)
+
+    def stopProducing(self):
+        # The process's input is closed, and anything more is dropped
+        self.resumeProducing()
+
+class GitConchUser(ConchUser):
+    commands = dict((name, find_git_command(name)) for name in GIT_COMMANDS)
+    # With workers, each enforces its share of the limits
+    processes = ProcessLimiter(shared_option('git-processes', 'limit', 0),
+                               shared_option('git-processes', 'userLimit', 0),
+                               shared_option('git-processes', 'addressLimit', 0),
+                               shared_option('git-processes', 'pushSlots', 0),
+                               option('git-processes', 'queueTimeout', 30))
+
+    def __init__(self, username, meta, fingerprint=None, password=None):
         ConchUser.__init__(self)
         self.username = username
-        self.channelLookup.update({"session": SSHSession})
+        self.channelLookup.update({"session": GitSSHSession})
         self.meta = meta
+        self.fingerprint = fingerprint
+        self.password = password
 
     def logout(self): pass
 
+registry.callback('gitssh_processes', 'Git processes running.', 'gauge',
+                  lambda: {(): GitConchUser.processes.running})
+registry.callback('gitssh_queued_sessions', 'Sessions waiting to start a git process.',
+                  'gauge', lambda: {('push',): GitConchUser.processes.queued(True),
+                                    ('read',): GitConchUser.processes.queued(False)},
+                  ['kind'])
+
+if backend_limiter:
+    registry.callback('gitssh_backend_calls', 'Auth service calls running or waiting to.',
+                      'gauge', lambda: {('running',): backend_limiter.running,
+                                        ('queued',): len(backend_limiter.queue)},
+                      ['state'])
+    registry.callback('gitssh_backend_unavailable_total',
+                      'Auth service calls refused, or given up on after the timeout.',
+                      'counter', lambda: {('refused',): backend_limiter.refused,
+                                          ('timeout',): backend_limiter.timeouts},
+                      ['reason'])
+    registry.callback('gitssh_backend_breaker', 'Auth service circuit breaker state.',
+                      'gauge', lambda: dict(((state,), int(backend_limiter.breaker.state == state))
+                                            for state in ('closed', 'open', 'half-open')),
+                      ['state'])
 
 class GitRealm(object):
     interface.implements(IRealm)
@@ -339,21 +575,35 @@ class GitRealm(object):
     def __init__(self, meta):
         self.meta = meta
 
-    def requestAvatar(self, username, mind, *interfaces):
-        user = GitConchUser(username, self.meta)
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        user = GitConchUser(avatarId.username, self.meta,
+                            avatarId.fingerprint, avatarId.password)
         return interfaces[0], user, user.logout
 
+class GitAvatarId(object):
+    """The user a connection logged in as, and the credentials it used.
+
+    Each connection carries its own credentials through to its avatar, so
+    concurrent logins do not share any state."""
+    def __init__(self, username, fingerprint=None, password=None):
+        self.username = username
+        self.fingerprint = fingerprint
+        self.password = password
+
+    def __str__(self):
+        return self.username
+
 class GitPubKeyChecker(object):
     """Skip most of the auth process until the SSH session starts.
 
-    Save the public key fingerprint for later use and verify the signature."""
+    Verify the signature, and keep the public key fingerprint for later use."""
     credentialInterfaces = ISSHPrivateKey,
     interface.implements(ICredentialsChecker)
 
     def __init__(self, meta):
         self.meta = meta
 
-    def verify(self, username, credentials, key):
+    def verify(self, result, credentials, key, fingerprint):
         # Verify the public key signature
         # From twisted.conch.checkers.SSHPublicKeyDatabase._cbRequestAvatarId
         if not credentials.signature:
@@ -363,22 +613,25 @@ class GitPubKeyChecker(object):
             # Ready, verify it
             try:
                 if key.verify(credentials.signature, credentials.sigData):
-                    return credentials.username
+                    return GitAvatarId(credentials.username, fingerprint=fingerprint)
             except:
                 log.err()
                 return Failure(UnauthorizedLogin("key could not verified"))
 
+    @timed(phase_seconds, phase='key')
     def requestAvatarId(self, credentials):
         key = Key.fromString(credentials.blob)
         fingerprint = key.fingerprint().replace(':', '')
-        self.meta.fingerprint = fingerprint
-        if (credentials.username == 'git'):
+        if (credentials.username == 'git' or self.meta.deferUserKeyCheck):
             # Todo, maybe verify the key with a process protocol call
             # (drush or http)
+            # When the user key check is deferred, GitSession.auth matches
+            # the fingerprint against the ssh_keys in the vcs-auth-data
+            # response instead, saving a backend round trip per connection.
             def success():
                 return credentials.username
             d = defer.maybeDeferred(success)
-            d.addCallback(self.verify, credentials, key)
+            d.addCallback(self.verify, credentials, key, fingerprint)
             return d
         else:
             """ If a user specified a non-git username, check that the user's key matches their username
@@ -393,68 +646,320 @@ class GitPubKeyChecker(object):
                 else:
                     return Failure(UnauthorizedLogin(credentials.username))
             service.addCallback(auth_callback)
-            service.addCallback(self.verify, credentials, key)
+            service.addCallback(self.verify, credentials, key, fingerprint)
             return service.deferred
 
 class GitPasswordChecker(object):
     """Skip most of the auth process until the SSH session starts.
 
-    Save the password hash for later use."""
+    Check the password against the user's stored hash, and keep the hash
+    for later use."""
     credentialInterfaces = IUsernamePassword,
     interface.implements(ICredentialsChecker)
 
     def __init__(self, meta):
         self.meta = meta
-
+        # Calculated hashes and failed logins, keyed by an HMAC of the
+        # password so that it is not kept in memory
+        self.secret = os.urandom(32)
+        self.hash_cache = ResponseCache(option('password-cache', 'ttl', 300),
+                                        option('password-cache', 'maxSize', 1000))
+        self.stored_hashes = ResponseCache(option('password-cache', 'storedHashTTL', 30),
+                                           option('password-cache', 'maxSize', 1000))
+        self.failed_logins = ResponseCache(option('password-cache', 'negativeTTL', 60),
+                                           option('password-cache', 'maxSize', 1000))
+        self.verifyWithBackend = option('password-cache', 'verifyWithBackend', False)
+
+    def hash_password(self, username, stored_hash, password, digest):
+        """Return a Deferred firing with the hash of password.
+
+        Stretching the password is slow, so it is done in a thread and the
+        result is cached for repeated logins with the same credentials."""
+        key = (username, stored_hash, digest)
+        return self.hash_cache.get(key, lambda: deferHash(stored_hash, password))
+
+    def fetchHash(self, username):
+        service = Service(AuthProtocol('drupalorg-vcs-auth-fetch-user-hash'))
+        service.request_json({"username":username})
+        # Cache unknown users as well
+        service.addCallback(lambda result: result or False)
+        return service.deferred
+
+    def checkAuth(self, username, password):
+        service = Service(AuthProtocol('drupalorg-vcs-auth-check-user-pass'))
+        service.request_bool({"username":username},
+                             {"password":password})
+        return service.deferred
+
+    @timed(phase_seconds, phase='password')
     def requestAvatarId(self, credentials):
-        def fetchHash(credentials):
-            service = Service(AuthProtocol('drupalorg-vcs-auth-fetch-user-hash'))
-            service.request_json({"username":credentials.username})
-            def auth_callback(result):
-                if result:
-                    self.meta.password = DrupalHash(result, credentials.password).get_hash()
-                    return checkAuth(credentials)
-            service.addCallback(auth_callback)
-            return service.deferred
+        username = credentials.username
+        digest = hmac.new(self.secret, credentials.password, hashlib.sha256).digest()
+        if self.failed_logins.cached((username, digest)):
+            return defer.fail(UnauthorizedLogin(username))
+
+        def failed():
+            self.failed_logins.set((username, digest), True)
+            return Failure(UnauthorizedLogin(username))
+
+        def hash_callback(stored_hash):
+            if not stored_hash:
+                return failed()
+            d = self.hash_password(username, stored_hash,
+                                   credentials.password, digest)
+            d.addCallback(auth_callback, stored_hash)
+            return d
 
-        def checkAuth(credentials):
-            service = Service(AuthProtocol('drupalorg-vcs-auth-check-user-pass'))
-            service.request_bool({"username":credentials.username},
-                                 {"password":self.meta.password})
-            def auth_callback(result):
-                if result:
-                    return credentials.username
-                else:
-                    return Failure(UnauthorizedLogin(credentials.username))
-            service.addCallback(auth_callback)
-            return service.deferred
-        return fetchHash(credentials)
+        def auth_callback(password, stored_hash):
+            if not password:
+                return failed()
+            if self.verifyWithBackend:
+                d = self.checkAuth(username, password)
+                d.addCallback(lambda result: result and password)
+                d.addCallback(verified)
+                return d
+            # The hash matches the stored one only for the right password
+            return verified(password == stored_hash and password)
+
+        def verified(password):
+            if password:
+                return GitAvatarId(username, password=password)
+            else:
+                return failed()
+
+        d = self.stored_hashes.get(username, lambda: self.fetchHash(username))
+        d.addCallback(hash_callback)
+        return d
+
+class GitSSHConnection(SSHConnection):
+    """An SSH connection which pauses the output of its sessions' processes
+    while more than bufferSize bytes are waiting to be sent to the client, and
+    which lets sessions hold back their window adjustments."""
+    bufferSize = option('flow-control', 'connectionBuffer', 1024) * 1024
+
+    def serviceStarted(self):
+        SSHConnection.serviceStarted(self)
+        self.congested = False
+        self.transport.transport.bufferSize = self.bufferSize
+        self.transport.transport.registerProducer(self, True)
+
+    def adjustWindow(self, channel, bytesToAdd):
+        if getattr(channel, 'holding', False):
+            # Adjusted when the session's process has taken the data
+            return
+        SSHConnection.adjustWindow(self, channel, bytesToAdd)
+
+    def pauseProducing(self):
+        self.congested = True
+        self.throttle()
+
+    def resumeProducing(self):
+        self.congested = False
+        self.throttle()
+
+    def stopProducing(self):
+        pass
+
+    def throttle(self):
+        for channel in self.channels.values():
+            if isinstance(channel, GitSSHSession):
+                channel.throttle()
+
+class GitServerTransport(SSHServerTransport):
+    """Keep track of the factory's open connections."""
+    def connectionMade(self):
+        SSHServerTransport.connectionMade(self)
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        SSHServerTransport.connectionLost(self, reason)
+        self.factory.connections.discard(self)
+
+def load_host_key(path):
+    """Return the private and public host keys at path and path.pub."""
+    pubkey = '.'.join((path, 'pub'))
+    return Key.fromFile(path), Key.fromFile(pubkey)
+
+def preferred(algorithms, preference):
+    """Sort algorithms in the order of preference, any others last."""
+    return sorted(algorithms, key=lambda algorithm: preference.index(algorithm)
+                  if algorithm in preference else len(preference))
 
 class GitServer(SSHFactory):
+    protocol = GitServerTransport
+    services = dict(SSHFactory.services, **{'ssh-connection': GitSSHConnection})
+    # Algorithms offered to clients, most preferred first. The client picks
+    # the first of its own list which is offered; OpenSSH prefers elliptic
+    # curves, unless it already knows another of the server's keys.
+    # Elliptic curve signatures and key exchange take far less CPU than RSA
+    # and finite field Diffie-Hellman.
+    publicKeyPreference = ['ssh-ed25519', 'ecdsa-sha2-nistp256', 'ecdsa-sha2-nistp384',
+                           'ecdsa-sha2-nistp521', 'ssh-rsa']
+    keyExchangePreference = ['curve25519-sha256', 'curve25519-sha256@libssh.org',
+                             'ecdh-sha2-nistp256', 'ecdh-sha2-nistp384',
+                             'ecdh-sha2-nistp521', 'diffie-hellman-group-exchange-sha256',
+                             'diffie-hellman-group14-sha1']
     authmeta = DrupalMeta()
+    password_checker = GitPasswordChecker(authmeta)
     portal = Portal(GitRealm(authmeta))
     portal.registerChecker(GitPubKeyChecker(authmeta))
-    portal.registerChecker(GitPasswordChecker(authmeta))
-
-    def __init__(self, privkey):
-        pubkey = '.'.join((privkey, 'pub'))
-        self.privateKeys = {'ssh-rsa': Key.fromFile(privkey)}
-        self.publicKeys = {'ssh-rsa': Key.fromFile(pubkey)}
+    portal.registerChecker(password_checker)
+
+    def __init__(self, privkey, host_keys=()):
+        private, public = load_host_key(privkey)
+        self.privateKeys = {'ssh-rsa': private}
+        self.publicKeys = {'ssh-rsa': public}
+        for path in host_keys:
+            # Offered along with the RSA key, which older clients may only
+            # know the server by
+            try:
+                private, public = load_host_key(path)
+            except Exception:
+                log.err(None, "Could not load the host key {0}".format(path))
+                continue
+            self.privateKeys[private.sshType()] = private
+            self.publicKeys[public.sshType()] = public
+        self.connections = set()
+        registry.callback('gitssh_connections', 'SSH connections open.', 'gauge',
+                          lambda: {(): len(self.connections)})
+        registry.callback('gitssh_cache_lookups_total',
+                          'Cache lookups, answered from the cache or not.',
+                          'counter', self.cache_lookups, ['cache', 'result'])
+        if self.authmeta.refs:
+            registry.callback('gitssh_noop_fetches_total',
+                              'Fetches which wanted nothing, answered without a git process.',
+                              'counter', lambda: {(): self.authmeta.refs.noops})
+
+    def buildProtocol(self, addr):
+        transport = SSHFactory.buildProtocol(self, addr)
+        transport.supportedPublicKeys = preferred(transport.supportedPublicKeys,
+                                                  self.publicKeyPreference)
+        transport.supportedKeyExchanges = preferred(transport.supportedKeyExchanges,
+                                                    self.keyExchangePreference)
+        return transport
+
+    def cache_lookups(self):
+        caches = {'auth': self.authmeta.auth_cache,
+                  'password_hash': self.password_checker.hash_cache,
+                  'stored_hash': self.password_checker.stored_hashes,
+                  'failed_login': self.password_checker.failed_logins}
+        if self.authmeta.packs:
+            caches['pack'] = self.authmeta.packs
+        if self.authmeta.refs:
+            caches['refs'] = self.authmeta.refs
+        lookups = {}
+        for name, cache in caches.iteritems():
+            lookups[(name, 'hit')] = cache.hits
+            lookups[(name, 'miss')] = cache.misses
+            if hasattr(cache, 'stale_hits'):
+                lookups[(name, 'stale')] = cache.stale_hits
+        return lookups
+
+    def startFactory(self):
+        SSHFactory.startFactory(self)
+        self.authmeta.pushctl.start()
+        if self.authmeta.repositories:
+            self.authmeta.repositories.start()
+        if self.authmeta.packs:
+            self.authmeta.packs.start()
+        if self.authmeta.spawner:
+            self.authmeta.spawner.start()
+
+    def stopFactory(self):
+        SSHFactory.stopFactory(self)
+        self.authmeta.pushctl.stop()
+        if self.authmeta.repositories:
+            self.authmeta.repositories.stop()
+        if self.authmeta.spawner:
+            self.authmeta.spawner.stop()
 
 class Server(object):
     def __init__(self):
         self.port = config.getint('drupalSSHGitServer', 'port')
         self.interface = config.get('drupalSSHGitServer', 'host')
         self.key = config.get('drupalSSHGitServer', 'privateKeyLocation')
+        self.host_keys = [path for path in
+                          (option('drupalSSHGitServer', 'ecdsaKeyLocation', ''),
+                           option('drupalSSHGitServer', 'ed25519KeyLocation', ''))
+                          if path]
+        self.control_socket = option('auth-cache', 'controlSocket', None)
+        self.workers = option('drupalSSHGitServer', 'workers', 0)
+        self.metrics_port = option('metrics', 'port', 0)
+        self.metrics_interface = option('metrics', 'interface', '127.0.0.1')
         components.registerAdapter(GitSession, GitConchUser, ISession)
 
     def application(self):
-        return GitServer(self.key)
+        return GitServer(self.key, self.host_keys)
+
+    def control(self, cache=None):
+        """Control the auth cache, or another object with invalidate and flush."""
+        return CacheControlFactory(cache or GitServer.authmeta.auth_cache)
+
+    def metrics(self):
+        """Serve the metrics of this process over HTTP."""
+        return MetricsSite()
+
+    def master(self):
+        """Run worker processes sharing the listening socket."""
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        return WorkerMaster(self.port, self.interface, self.workers, script)
+
+def run_worker(ssh_server, fd, family, number):
+    """Serve connections on a listening socket inherited from the master."""
+    factory = ssh_server.application()
+    port = reactor.adoptStreamPort(fd, family, factory)
+    os.close(fd)
+    metrics_ports = []
+    def listen_metrics():
+        # Each worker serves its own metrics, on the port after the previous
+        # worker's. The worker this one replaces may still hold the port.
+        if getattr(factory, 'draining', False):
+            return
+        try:
+            metrics_ports.append(reactor.listenTCP(ssh_server.metrics_port + number,
+                                                   ssh_server.metrics(),
+                                                   interface=ssh_server.metrics_interface))
+        except CannotListenError:
+            reactor.callLater(1, listen_metrics)
+    if ssh_server.metrics_port:
+        listen_metrics()
+    def stop():
+        for metrics_port in metrics_ports:
+            metrics_port.stopListening()
+        del metrics_ports[:]
+        drain(port, factory)
+    # Cache control commands are forwarded from the master on stdin. If the
+    # master goes away, finish the open sessions and exit.
+    control = ssh_server.control().buildProtocol(None)
+    control.connectionLost = lambda reason: stop()
+    stdio.StandardIO(control)
+    # Exit gracefully when the master is reloaded or stopped
+    reactor.callWhenRunning(signal.signal, signal.SIGTERM,
+        lambda *args: reactor.callFromThread(stop))
 
 if __name__ == '__main__':
     log.startLogging(sys.stderr)
     ssh_server = Server()
-    reactor.listenTCP(ssh_server.port, 
-                      ssh_server.application(), 
-                      interface=ssh_server.interface)
+    if sys.argv[1:2] == ['--worker']:
+        # Started by the master: --worker fd family number
+        run_worker(ssh_server, int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        if ssh_server.workers:
+            master = ssh_server.master()
+            master.startService()
+            reactor.addSystemEventTrigger('before', 'shutdown', master.stopService)
+            control = ssh_server.control(master)
+        else:
+            reactor.listenTCP(ssh_server.port, 
+                              ssh_server.application(), 
+                              interface=ssh_server.interface)
+            control = ssh_server.control()
+            if ssh_server.metrics_port:
+                reactor.listenTCP(ssh_server.metrics_port,
+                                  ssh_server.metrics(),
+                                  interface=ssh_server.metrics_interface)
+        if ssh_server.control_socket:
+            reactor.listenUNIX(ssh_server.control_socket,
+                               control,
+                               wantPID=True)
     reactor.run()
@@ -1,4 +1,5 @@
 import hashlib
+from twisted.internet import threads
 
 # Calculate a non-truncated Drupal 7 compatible password hash.
 # The consumer of these hashes must truncate correctly.
@@ -33,7 +34,7 @@ class DrupalHash:
         else:
             return False
         hash_str = hash_func(salt + password).digest()
-        for c in range(count):
+        for c in xrange(count):
             hash_str = hash_func(hash_str + password).digest()
         output = setting + self.custom64(hash_str)
         return output
@@ -41,29 +42,30 @@ class DrupalHash:
     def custom64(self, string, count = 0):
         if count == 0:
             count = len(string)
-        output = ''
+        output = []
+        append = output.append
         i = 0
         itoa64 = self.itoa64
         while 1:
             value = ord(string[i])
             i += 1
-            output += itoa64[value & 0x3f]
+            append(itoa64[value & 0x3f])
             if i < count:
                 value |= ord(string[i]) << 8
-            output += itoa64[(value >> 6) & 0x3f]
+            append(itoa64[(value >> 6) & 0x3f])
             if i >= count:
                 break
             i += 1
             if i < count:
                 value |= ord(string[i]) << 16
-            output += itoa64[(value >> 12) & 0x3f]
+            append(itoa64[(value >> 12) & 0x3f])
             if i >= count:
                 break
             i += 1
-            output += itoa64[(value >> 18) & 0x3f]
+            append(itoa64[(value >> 18) & 0x3f])
             if i >= count:
                break
-        return output
+        return ''.join(output)
 
     def rehash(self, stored_hash, password):
         hash_length = len(stored_hash)
@@ -91,6 +93,11 @@ class DrupalHash:
         # Only return the length that Drupal has stored
         return hash_str[:hash_length]
 
+def deferHash(stored_hash, password):
+    """Calculate the hash in a thread, so the reactor is not blocked while
+    the password is stretched. Returns a Deferred firing with the hash."""
+    return threads.deferToThread(lambda: DrupalHash(stored_hash, password).get_hash())
+
 if __name__ == "__main__":
     ha = '$S$D5z1Wm4bevjS5EQ3OdB.lI0NFTnCyIuD6VFHs5fkdjFHo0lvsdmv'
     pw = 'admin'
@@ -0,0 +1,129 @@
+from collections import deque, OrderedDict
+from twisted.conch.error import ConchError
+from twisted.internet import defer, reactor
+
+class ServerBusy(ConchError):
+    pass
+
+class ProcessSlot(object):
+    """Permission for one git process to run, given back with release()."""
+    def __init__(self, limiter, user, address, push):
+        self.limiter = limiter
+        self.user = user
+        self.address = address
+        self.push = push
+        self.deferred = defer.Deferred(self.cancel)
+        self.timeout = None
+        self.released = False
+
+    def cancel(self, deferred):
+        self.limiter.dequeue(self)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release(self)
+
+class ProcessLimiter(object):
+    """Admit git processes up to a global limit, and limits per user and per
+    remote address. A limit of 0 is no limit.
+
+    Sessions over a limit wait in a queue, served round robin between users
+    (or addresses, for anonymous sessions) so a burst from one of them does
+    not starve the others. Waiting pushes are served first, and push_slots
+    of the global limit are kept for pushes only."""
+    def __init__(self, limit, user_limit, address_limit, push_slots, timeout, clock=reactor):
+        self.limit = limit
+        self.user_limit = user_limit
+        self.address_limit = address_limit
+        self.push_slots = push_slots
+        self.timeout = timeout
+        self.clock = clock
+        self.running = 0
+        self.users = {}
+        self.addresses = {}
+        # User or address: deque of waiting slots, in round robin order
+        self.push_queues = OrderedDict()
+        self.read_queues = OrderedDict()
+
+    def acquire(self, user, address, push):
+        """Return a Deferred firing with a ProcessSlot once the process may
+        start, or failing with ServerBusy if it waited too long."""
+        slot = ProcessSlot(self, user, address, push)
+        queues = self.push_queues if push else self.read_queues
+        queues.setdefault(self.queue_key(slot), deque()).append(slot)
+        self.dispatch()
+        if not slot.deferred.called:
+            slot.timeout = self.clock.callLater(self.timeout, self.timedOut, slot)
+        return slot.deferred
+
+    def queued(self, push):
+        """Return the number of waiting pushes, or reads."""
+        queues = self.push_queues if push else self.read_queues
+        return sum(len(queue) for queue in queues.itervalues())
+
+    def queue_key(self, slot):
+        return slot.user if slot.user is not None else slot.address
+
+    def allowed(self, slot):
+        if (self.user_limit and slot.user is not None and
+                self.users.get(slot.user, 0) >= self.user_limit):
+            return False
+        if (self.address_limit and
+                self.addresses.get(slot.address, 0) >= self.address_limit):
+            return False
+        if not self.limit:
+            return True
+        elif slot.push:
+            return self.running < self.limit
+        else:
+            return self.running < self.limit - self.push_slots
+
+    def dispatch(self):
+        for queues in (self.push_queues, self.read_queues):
+            admitted = True
+            while admitted:
+                # One pass admits at most one slot from each queue
+                admitted = False
+                for key in list(queues):
+                    queue = queues.pop(key, None)
+                    if not queue:
+                        # Emptied by a callback of an admitted slot
+                        continue
+                    if self.allowed(queue[0]):
+                        self.admit(queue.popleft())
+                        admitted = True
+                    if queue:
+                        # Back of the round robin
+                        queues[key] = queue
+
+    def admit(self, slot):
+        if slot.timeout and slot.timeout.active():
+            slot.timeout.cancel()
+        self.running += 1
+        self.users[slot.user] = self.users.get(slot.user, 0) + 1
+        self.addresses[slot.address] = self.addresses.get(slot.address, 0) + 1
+        slot.deferred.callback(slot)
+
+    def dequeue(self, slot):
+        queues = self.push_queues if slot.push else self.read_queues
+        key = self.queue_key(slot)
+        queue = queues.get(key)
+        if queue and slot in queue:
+            queue.remove(slot)
+            if not queue:
+                del queues[key]
+            if slot.timeout and slot.timeout.active():
+                slot.timeout.cancel()
+
+    def timedOut(self, slot):
+        self.dequeue(slot)
+        slot.deferred.errback(ServerBusy("The server is busy. Please try again later."))
+
+    def release(self, slot):
+        self.running -= 1
+        for counts, key in ((self.users, slot.user), (self.addresses, slot.address)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        self.dispatch()
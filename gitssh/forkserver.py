@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""The spawner helper: a small process which starts git processes for the
+daemon, so that the daemon itself is not forked for each session.
+
+It reads commands from a Unix socket (SOCK_SEQPACKET) at the file descriptor
+given on its command line. Each command is a JSON message:
+
+    {"id": number, "executable": path, "args": [...], "env": {...}}
+
+sent with the process's stdin, stdout and stderr pipes attached as
+SCM_RIGHTS. The process is forked from the helper and the executable run
+directly, with no shell in between. When it exits, "id status" is written to
+the helper's stdout, status as waitpid returns it. The daemon may also send
+
+    {"id": number, "signal": signal number}
+
+The helper exits when the daemon closes the socket; the processes it started
+carry on until their pipes are closed.
+
+Only the standard library and Twisted's sendmsg are imported, to keep the
+helper small."""
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+from twisted.python.sendmsg import send1msg, recv1msg, SCM_RIGHTS
+
+# Largest command read, mostly the environment
+MAX_MESSAGE = 256 * 1024
+MSG_TRUNC = 0x20
+# Pipes attached to each command: stdin, stdout and stderr
+FDS = struct.Struct("3i")
+
+def send_command(sock, message, fds=()):
+    """Send a command to the helper over sock, attaching fds."""
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, SCM_RIGHTS, FDS.pack(*fds)))
+    send1msg(sock.fileno(), json.dumps(message), 0, ancillary)
+
+def strings(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class ForkServer(object):
+    def __init__(self, sock):
+        self.sock = sock
+        # pid: id, and id: pid, of the processes running
+        self.ids = {}
+        self.pids = {}
+
+    def serve(self):
+        # SIGCHLD wakes up the select through this pipe
+        wakeup, self.wakeup = os.pipe()
+        for fd in wakeup, self.wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wakeup)
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        while True:
+            try:
+                readable = select.select([self.sock, wakeup], [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if wakeup in readable:
+                try:
+                    os.read(wakeup, 4096)
+                except OSError:
+                    pass
+                self.reap()
+            if self.sock in readable:
+                try:
+                    data, flags, ancillary = recv1msg(self.sock.fileno(), 0, MAX_MESSAGE)
+                except socket.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not data:
+                    # The daemon has gone
+                    return
+                fds = []
+                for level, kind, fd_data in ancillary:
+                    if level == socket.SOL_SOCKET and kind == SCM_RIGHTS:
+                        fds.extend(struct.unpack("{0}i".format(len(fd_data) // 4), fd_data))
+                try:
+                    if flags & MSG_TRUNC:
+                        raise ValueError("Command over {0} bytes".format(MAX_MESSAGE))
+                    self.command(json.loads(data), fds)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+    def command(self, message, fds):
+        number = message["id"]
+        if "signal" in message:
+            pid = self.pids.get(number)
+            if pid:
+                try:
+                    os.kill(pid, message["signal"])
+                except OSError:
+                    pass
+            return
+        if len(fds) != FDS.size // 4:
+            raise ValueError("Command {0} has {1} descriptors".format(number, len(fds)))
+        executable = strings(message["executable"])
+        args = [strings(arg) for arg in message["args"]]
+        env = dict((strings(key), strings(value))
+                   for key, value in message["env"].iteritems())
+        try:
+            pid = os.fork()
+        except OSError, e:
+            os.write(fds[2], "fatal: could not start {0}: {1}\n".format(args[0], e.strerror))
+            self.exited(number, 127 << 8)
+            return
+        if pid == 0:
+            self.child(fds, executable, args, env)
+        self.ids[pid] = number
+        self.pids[number] = pid
+
+    def child(self, fds, executable, args, env):
+        try:
+            # The helper's own stdio stays open, so the pipes are above 2
+            for child_fd, fd in enumerate(fds):
+                os.dup2(fd, child_fd)
+            os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+            # Python ignores SIGPIPE, which git should not
+            for signalnum in range(1, signal.NSIG):
+                if signal.getsignal(signalnum) not in (signal.SIG_DFL, None):
+                    signal.signal(signalnum, signal.SIG_DFL)
+            os.execve(executable, args, env)
+        except:
+            try:
+                os.write(2, "fatal: could not start {0}: {1}\n".format(
+                         args[0], sys.exc_info()[1]))
+            finally:
+                os._exit(127)
+
+    def reap(self):
+        while self.ids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if not pid:
+                return
+            number = self.ids.pop(pid, None)
+            if number is not None:
+                del self.pids[number]
+                self.exited(number, status)
+
+    def exited(self, number, status):
+        os.write(1, "{0} {1}\n".format(number, status))
+
+if __name__ == '__main__':
+    fd = int(sys.argv[1])
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    os.close(fd)
+    ForkServer(sock).serve()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+"""Load test the SSH daemon against a stub auth service.
+
+The daemon is started on localhost with its auth service replaced by
+StubServiceProtocol, which answers like drush or http would after a fixed
+delay, with auth data of a configurable size. Concurrent OpenSSH git clients
+then run a mix of clones, fetches, pushes and failed logins against a
+fixture repository, and the sessions per second, latencies, and the CPU and
+memory used by the daemon are reported. Slow clones read the pack at a fixed
+rate, to show the memory the daemon holds for clients that do not keep up.
+
+Run from the repository root with: python -m gitssh.loadtest --help"""
+import json
+import optparse
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+if __name__ == "__main__" and not __package__:
+    # Started as a script by the worker master
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zope.interface import implements
+
+from service import IServiceProtocol
+
+PHASES = ('key', 'request', 'pushcontrol', 'auth', 'queue', 'process')
+OPERATIONS = ('clone', 'slowclone', 'fetch', 'push', 'failauth')
+
+# The daemon side
+
+class StubBackend(object):
+    """Canned auth service responses, as the raw strings drush or http return."""
+    def __init__(self, fingerprint, users, latency):
+        self.fingerprint = fingerprint
+        self.latency = latency
+        rng = random.Random(0)
+        maintainers = {}
+        for uid in range(1, users + 1):
+            name = "bench" if uid == 1 else "maintainer{0}".format(uid)
+            keys = dict(("key{0}".format(n), "%032x" % rng.getrandbits(128))
+                        for n in range(3))
+            if uid == 1:
+                keys["key0"] = fingerprint
+            maintainers[name] = {"uid": uid, "repo_id": 1, "access": 2,
+                                 "branch_create": True, "branch_update": True,
+                                 "branch_delete": True, "tag_create": True,
+                                 "tag_update": True, "tag_delete": True,
+                                 "per_label": [], "name": name, "global": 0,
+                                 "pass": "%032x" % rng.getrandbits(128),
+                                 "ssh_keys": keys}
+        self.auth_data = json.dumps({"repo_id": 1, "status": 1,
+                                     "repo_group": 2, "users": maintainers})
+
+    def respond(self, command, args):
+        if command == 'vcs-auth-data':
+            return self.auth_data
+        elif command == 'pushctl-state':
+            return "0"
+        elif command == 'drupalorg-ssh-user-key':
+            matches = (args[0]["username"] == "bench" and
+                       args[1]["fingerprint"] == self.fingerprint)
+            return "true" if matches else "false"
+        elif command == 'drupalorg-vcs-auth-fetch-user-hash':
+            return "false"
+        else:
+            return "false"
+
+backend = None
+
+class StubServiceProtocol(object):
+    """Answer requests from the StubBackend after its latency."""
+    implements(IServiceProtocol)
+
+    def __init__(self, command):
+        from twisted.internet import defer
+        self.command = command
+        self.deferred = defer.Deferred()
+
+    def request(self, *args):
+        from twisted.internet import reactor
+        reactor.callLater(backend.latency, self.deferred.callback,
+                          backend.respond(self.command, args))
+
+def serve(args):
+    """Run the daemon with the stub auth service, as the master or a worker."""
+    global backend
+    workdir = os.environ['LOADTEST_DIR']
+    settings = json.load(open(os.path.join(workdir, 'stub.json')))
+    backend = StubBackend(settings['fingerprint'], settings['users'],
+                          settings['latency'])
+
+    # Installs the epoll reactor, so it is imported first
+    import drupalGitSSHDaemon
+    from twisted.internet import reactor
+    from twisted.python import log
+    from gitssh.workers import WorkerMaster
+    drupalGitSSHDaemon.AuthProtocol = StubServiceProtocol
+
+    log.startLogging(sys.stderr)
+    ssh_server = drupalGitSSHDaemon.Server()
+    if args[0] == '--worker':
+        drupalGitSSHDaemon.run_worker(ssh_server, int(args[1]), int(args[2]),
+                                      int(args[3]))
+    elif ssh_server.workers:
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        master = WorkerMaster(ssh_server.port, ssh_server.interface,
+                              ssh_server.workers, script)
+        master.startService()
+        reactor.addSystemEventTrigger('before', 'shutdown', master.stopService)
+    else:
+        reactor.listenTCP(ssh_server.port, ssh_server.application(),
+                          interface=ssh_server.interface)
+        reactor.listenTCP(ssh_server.metrics_port, ssh_server.metrics(),
+                          interface=ssh_server.metrics_interface)
+    reactor.run()
+
+# The client side
+
+CONFIG = """
+[drupalSSHGitServer]
+privateKeyLocation={workdir}/hostkey
+{host_keys}
+host=127.0.0.1
+port={port}
+workers={workers}
+repositoryPath={workdir}/repositories/project
+anonymousReadAccess=false
+authServiceProtocol=http
+pushctlInterval=30
+
+[auth-cache]
+ttl={auth_cache_ttl}
+
+[pack-cache]
+enabled={pack_cache}
+directory={workdir}/packs
+
+[metrics]
+port={metrics_port}
+interface=127.0.0.1
+
+[project]
+repositoryPath={workdir}/repositories/project
+
+[http-settings]
+; Not used, requests are answered by the stub
+serviceUrl=http://127.0.0.1:1/
+"""
+
+SSH_WRAPPER = """#!/bin/sh
+exec ssh -q -i {key} -p {port} -o BatchMode=yes -o IdentitiesOnly=yes \\
+    -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null \\
+    -o HostKeyAlgorithms=+ssh-rsa -o PubkeyAcceptedKeyTypes=+ssh-rsa "$@"
+"""
+
+def pkt_line(data):
+    return "{0:04x}{1}".format(len(data) + 4, data)
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def run(args, cwd=None, env=None):
+    """Run a command, and return its exit status and first line of output."""
+    process = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, (output.strip().splitlines() or [""])[0]
+
+def check(args, cwd=None, env=None):
+    status, output = run(args, cwd, env)
+    if status:
+        raise Exception("{0} failed: {1}".format(" ".join(args), output))
+
+class Fixture(object):
+    """Keys, a repository with files_count files, and the daemon's config, in a
+    temporary directory."""
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='gitssh-loadtest-')
+        self.port = free_port()
+        self.metrics_port = free_port()
+        self.url = "git@127.0.0.1:/project/bench.git"
+
+    def keygen(self, name, type='rsa'):
+        path = os.path.join(self.workdir, name)
+        size = {'rsa': ['-b', '2048', '-m', 'PEM'], 'ecdsa': ['-b', '256']}.get(type, [])
+        check(['ssh-keygen', '-q', '-t', type] + size + ['-N', '', '-f', path])
+        return path
+
+    def ssh_wrapper(self, name, key):
+        path = os.path.join(self.workdir, name)
+        wrapper = open(path, 'w')
+        wrapper.write(SSH_WRAPPER.format(key=key, port=self.port))
+        wrapper.close()
+        os.chmod(path, 0755)
+        return path
+
+    def create(self):
+        from twisted.conch.ssh.keys import Key
+        options = self.options
+        self.keygen('hostkey')
+        host_keys = ""
+        if options.host_key != 'rsa':
+            # Offered along with the RSA key, and preferred by the client
+            host_keys = "{0}KeyLocation={1}".format(
+                options.host_key, self.keygen('hostkey-' + options.host_key, options.host_key))
+        client_key = self.keygen('clientkey')
+        bad_key = self.keygen('badkey')
+        fingerprint = Key.fromFile(client_key + '.pub').fingerprint().replace(':', '')
+        self.env = dict(os.environ, GIT_SSH=self.ssh_wrapper('ssh', client_key),
+                        GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+                        GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+        self.bad_ssh = self.ssh_wrapper('badssh', bad_key)
+
+        # The repository, with files of random words
+        bare = os.path.join(self.workdir, 'repositories', 'project', 'bench.git')
+        source = os.path.join(self.workdir, 'source')
+        check(['git', 'init', '-q', '--bare', bare])
+        check(['git', 'init', '-q', source])
+        rng = random.Random(0)
+        words = ["".join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                         for i in range(rng.randint(2, 10))) for n in range(2000)]
+        for n in range(options.files):
+            sample = open(os.path.join(source, "file{0}.txt".format(n)), 'w')
+            sample.write(" ".join(rng.choice(words) for i in range(700)))
+            sample.close()
+        check(['git', 'add', '.'], cwd=source, env=self.env)
+        check(['git', 'commit', '-q', '-m', 'Fixture'], cwd=source, env=self.env)
+        check(['git', 'push', '-q', bare, 'HEAD:refs/heads/master'], cwd=source,
+              env=self.env)
+
+        config = open(os.path.join(self.workdir, 'drupaldaemons.cnf'), 'w')
+        config.write(CONFIG.format(workdir=self.workdir, port=self.port,
+                                   host_keys=host_keys,
+                                   workers=options.workers,
+                                   auth_cache_ttl=options.auth_cache_ttl,
+                                   pack_cache=str(options.pack_cache).lower(),
+                                   metrics_port=self.metrics_port))
+        config.close()
+        json.dump({'fingerprint': fingerprint, 'users': options.users,
+                   'latency': options.latency},
+                  open(os.path.join(self.workdir, 'stub.json'), 'w'))
+
+    def start(self):
+        env = dict(os.environ, LOADTEST_DIR=self.workdir,
+                   DRUPALDAEMONS_CNF=os.path.join(self.workdir, 'drupaldaemons.cnf'))
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        self.log = open(os.path.join(self.workdir, 'daemon.log'), 'w')
+        self.daemon = subprocess.Popen([sys.executable, script, '--serve'],
+                                       env=env, stdout=self.log,
+                                       stderr=subprocess.STDOUT)
+        ports = [self.port] + self.metrics_ports()
+        deadline = time.time() + 30
+        while ports:
+            if self.daemon.poll() is not None or time.time() > deadline:
+                raise Exception("The daemon did not start, see {0}".format(
+                                self.log.name))
+            try:
+                socket.create_connection(('127.0.0.1', ports[0]), 1).close()
+                ports.pop(0)
+            except socket.error:
+                time.sleep(0.1)
+
+    def metrics_ports(self):
+        return [self.metrics_port + n for n in range(max(self.options.workers, 1))]
+
+    def stop(self):
+        if self.daemon.poll() is None:
+            self.daemon.send_signal(signal.SIGTERM)
+            self.daemon.wait()
+        self.log.close()
+        if self.options.keep:
+            print "Kept {0}".format(self.workdir)
+        else:
+            shutil.rmtree(self.workdir)
+
+class Client(threading.Thread):
+    """Run sessions from the mix, until the load test has run enough."""
+    def __init__(self, number, test):
+        threading.Thread.__init__(self)
+        self.number = number
+        self.test = test
+        self.fixture = test.fixture
+        self.rng = random.Random(number)
+        self.checkout = os.path.join(self.fixture.workdir, "client{0}".format(number))
+        self.pushes = 0
+
+    def setup(self):
+        if 'fetch' in self.test.mix or 'push' in self.test.mix:
+            check(['git', 'clone', '-q', self.fixture.url, self.checkout],
+                  env=self.fixture.env)
+
+    def run(self):
+        while self.test.next_session():
+            operation = self.rng.choice(self.test.mix)
+            start = time.time()
+            status, output = getattr(self, operation)()
+            self.test.record(operation, time.time() - start, status, output)
+
+    def clone(self):
+        target = os.path.join(self.fixture.workdir, "clone{0}".format(self.number))
+        result = run(['git', 'clone', '-q', self.fixture.url, target],
+                     env=self.fixture.env)
+        shutil.rmtree(target, ignore_errors=True)
+        return result
+
+    def slowclone(self):
+        """Ask for the whole repository, and read the pack at the slow rate."""
+        ssh = subprocess.Popen([self.fixture.env['GIT_SSH'], 'git@127.0.0.1',
+                                "git-upload-pack '/project/bench.git'"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, 'w'))
+        try:
+            wants = []
+            while True:
+                length = int(ssh.stdout.read(4) or '0', 16)
+                if not length:
+                    break
+                line = ssh.stdout.read(length - 4).split('\0')[0].rstrip('\n')
+                sha, ref = line.split(' ', 1)
+                if ref.startswith('refs/heads/'):
+                    wants.append(sha)
+            if not wants:
+                return 1, "No refs were advertised"
+            request = "".join(pkt_line("want {0}\n".format(sha)) for sha in wants)
+            ssh.stdin.write(request + "0000" + pkt_line("done\n"))
+            ssh.stdin.flush()
+            chunk = max(self.test.options.slow_rate // 10, 1)
+            received = 0
+            while True:
+                data = ssh.stdout.read(chunk)
+                if not data:
+                    break
+                received += len(data)
+                time.sleep(0.1)
+            ssh.stdin.close()
+            status = ssh.wait()
+            return status, "{0} bytes".format(received)
+        finally:
+            if ssh.poll() is None:
+                ssh.kill()
+                ssh.wait()
+
+    def fetch(self):
+        return run(['git', 'fetch', '-q', 'origin'], cwd=self.checkout,
+                   env=self.fixture.env)
+
+    def push(self):
+        self.pushes += 1
+        change = open(os.path.join(self.checkout, "client{0}.txt".format(self.number)), 'w')
+        change.write("{0}\n".format(self.pushes))
+        change.close()
+        check(['git', 'add', '.'], cwd=self.checkout, env=self.fixture.env)
+        check(['git', 'commit', '-q', '-m', 'Push'], cwd=self.checkout,
+              env=self.fixture.env)
+        return run(['git', 'push', '-q', 'origin',
+                    "HEAD:refs/heads/client{0}".format(self.number)],
+                   cwd=self.checkout, env=self.fixture.env)
+
+    def failauth(self):
+        # A named user with a key that is not theirs is refused at login
+        status, output = run([self.fixture.bad_ssh, 'bench@127.0.0.1',
+                              "git-upload-pack '/project/bench.git'"])
+        return (0 if status == 255 else 1), output
+
+class LoadTest(object):
+    def __init__(self, fixture, options):
+        self.fixture = fixture
+        self.options = options
+        self.mix = []
+        for part in options.mix.split(','):
+            operation, weight = part.split('=')
+            if operation not in OPERATIONS:
+                raise ValueError("Unknown operation {0}".format(operation))
+            self.mix.extend([operation] * int(weight))
+        self.lock = threading.Lock()
+        self.started = 0
+        self.timings = {}
+        self.failures = {}
+        # Resident kB of the daemon, sampled every second
+        self.rss = []
+        self.running = False
+
+    def next_session(self):
+        with self.lock:
+            if self.started >= self.options.sessions:
+                return False
+            self.started += 1
+            return True
+
+    def record(self, operation, seconds, status, output):
+        with self.lock:
+            self.timings.setdefault(operation, []).append(seconds)
+            if status:
+                self.failures.setdefault(operation, []).append(output)
+
+    def run(self):
+        clients = [Client(n, self) for n in range(self.options.concurrency)]
+        for client in clients:
+            client.setup()
+        before = usage(self.fixture.daemon.pid)
+        # Leave out the sessions of the setup
+        phases_before = phase_histograms(self.fixture.metrics_ports())
+        start = time.time()
+        self.running = True
+        sampler = threading.Thread(target=self.sample)
+        sampler.start()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.elapsed = time.time() - start
+        self.running = False
+        sampler.join()
+        self.usage = [after - earlier for after, earlier
+                      in zip(usage(self.fixture.daemon.pid), before)]
+        self.memory = memory(self.fixture.daemon.pid)
+        phases = phase_histograms(self.fixture.metrics_ports())
+        self.phases = {}
+        for phase, buckets in phases.items():
+            earlier = dict(phases_before.get(phase, []))
+            self.phases[phase] = [(bound, count - earlier.get(bound, 0))
+                                  for bound, count in buckets]
+
+    def sample(self):
+        while self.running:
+            self.rss.append(memory(self.fixture.daemon.pid)[0])
+            time.sleep(1)
+
+# Measurements
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                stat = open('/proc/{0}/stat'.format(entry)).read()
+            except IOError:
+                continue
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+def usage(pid):
+    """Return the CPU seconds used by the daemon's processes, and by the git
+    processes they have reaped."""
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    own = reaped = 0
+    for process in process_tree(pid):
+        try:
+            fields = open('/proc/{0}/stat'.format(process)).read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        # utime, stime, cutime, cstime
+        own += int(fields[11]) + int(fields[12])
+        reaped += int(fields[13]) + int(fields[14])
+    return own / ticks, reaped / ticks
+
+def memory(pid):
+    """Return the resident and peak resident kB of the daemon's processes,
+    other than git."""
+    rss = peak = 0
+    for process in process_tree(pid):
+        try:
+            status = open('/proc/{0}/status'.format(process)).read()
+        except IOError:
+            continue
+        if 'git' in re.search(r'Name:\s*(\S+)', status).group(1):
+            continue
+        rss += int(re.search(r'VmRSS:\s*(\d+)', status).group(1))
+        peak += int(re.search(r'VmHWM:\s*(\d+)', status).group(1))
+    return rss, peak
+
+def phase_histograms(ports):
+    """Return phase: [(bound, cumulative count)] summed over the daemon's
+    metrics endpoints."""
+    pattern = re.compile(r'gitssh_phase_seconds_bucket\{phase="(\w+)",le="([^"]+)"\} (\d+)')
+    buckets = {}
+    for port in ports:
+        text = urllib2.urlopen('http://127.0.0.1:{0}/'.format(port)).read()
+        for phase, bound, count in pattern.findall(text):
+            bound = float(bound)
+            phase_buckets = buckets.setdefault(phase, {})
+            phase_buckets[bound] = phase_buckets.get(bound, 0) + int(count)
+    return dict((phase, sorted(counts.items())) for phase, counts in buckets.items())
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+def histogram_quantile(buckets, fraction):
+    """Estimate a quantile from cumulative buckets, as Prometheus does."""
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    rank = fraction * total
+    lower, below = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+        lower, below = bound, count
+    return lower
+
+def report(test):
+    sessions = sum(len(timings) for timings in test.timings.values())
+    print "{0} sessions in {1:.1f} s: {2:.1f} sessions/s".format(
+        sessions, test.elapsed, sessions / test.elapsed)
+    print
+    print "{0:<10} {1:>7} {2:>9} {3:>9} {4:>9}".format(
+        "session", "count", "failed", "p50 ms", "p99 ms")
+    for operation, timings in sorted(test.timings.items()):
+        print "{0:<10} {1:>7} {2:>9} {3:>9.1f} {4:>9.1f}".format(
+            operation, len(timings), len(test.failures.get(operation, [])),
+            percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000)
+    print
+    print "{0:<10} {1:>7} {2:>9} {3:>9}".format("phase", "count", "p50 ms", "p99 ms")
+    for phase in PHASES:
+        if phase in test.phases:
+            buckets = test.phases[phase]
+            print "{0:<10} {1:>7} {2:>9.1f} {3:>9.1f}".format(
+                phase, buckets[-1][1], histogram_quantile(buckets, 0.5) * 1000,
+                histogram_quantile(buckets, 0.99) * 1000)
+    print
+    own, reaped = test.usage
+    print "CPU: daemon {0:.2f} s ({1:.2f} ms/session), git {2:.2f} s ({3:.2f} ms/session)".format(
+        own, own / sessions * 1000, reaped, reaped / sessions * 1000)
+    print "RSS: {0:.1f} MB, peak {1:.1f} MB".format(test.memory[0] / 1024.0,
+                                                  test.memory[1] / 1024.0)
+    if test.rss:
+        print "RSS during the run: {0:.1f} MB at the start, {1:.1f} MB at most".format(
+            test.rss[0] / 1024.0, max(test.rss) / 1024.0)
+    for operation, outputs in sorted(test.failures.items()):
+        print "{0} failures, e.g.: {1}".format(operation, outputs[0])
+
+def results(test):
+    """The results as a dict, to compare runs."""
+    sessions = sum(len(timings) for timings in test.timings.values())
+    return {
+        'sessions': sessions,
+        'sessions_per_second': sessions / test.elapsed,
+        'operations': dict((operation, {
+            'count': len(timings),
+            'failed': len(test.failures.get(operation, [])),
+            'p50': percentile(timings, 0.5),
+            'p99': percentile(timings, 0.99)})
+            for operation, timings in test.timings.items()),
+        'phases': dict((phase, {
+            'p50': histogram_quantile(buckets, 0.5),
+            'p99': histogram_quantile(buckets, 0.99)})
+            for phase, buckets in test.phases.items()),
+        'cpu_per_session': test.usage[0] / sessions,
+        'git_cpu_per_session': test.usage[1] / sessions,
+        'rss_kb': test.memory[0],
+        'peak_rss_kb': test.memory[1],
+        'rss_samples_kb': test.rss,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="python -m gitssh.loadtest [options]")
+    parser.add_option('-c', '--concurrency', type='int', default=8,
+                      help="clients running sessions at once [%default]")
+    parser.add_option('-n', '--sessions', type='int', default=200,
+                      help="sessions to run in total [%default]")
+    parser.add_option('--mix', default='clone=2,fetch=4,push=1,failauth=1',
+                      help="weights of each kind of session [%default]")
+    parser.add_option('--slow-rate', type='int', default=65536,
+                      help="bytes a second each slow clone reads [%default]")
+    parser.add_option('--latency', type='float', default=0.02,
+                      help="seconds the stub auth service takes to answer [%default]")
+    parser.add_option('--users', type='int', default=50,
+                      help="maintainers in the repository's auth data [%default]")
+    parser.add_option('--files', type='int', default=200,
+                      help="files of about 4 kB in the repository [%default]")
+    parser.add_option('--workers', type='int', default=0,
+                      help="daemon worker processes [%default]")
+    parser.add_option('--auth-cache-ttl', type='int', default=60,
+                      help="seconds auth data is cached, 0 to ask for every session [%default]")
+    parser.add_option('--host-key', type='choice', choices=['rsa', 'ecdsa', 'ed25519'],
+                      default='rsa',
+                      help="host key clients verify: rsa, or ecdsa or ed25519 offered "
+                           "along with rsa [%default]")
+    parser.add_option('--pack-cache', action='store_true', default=False,
+                      help="serve repeated clones from the pack cache")
+    parser.add_option('--json', metavar='FILE',
+                      help="also write the results to FILE, to compare runs")
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="keep the working directory, with the daemon's log")
+    options, args = parser.parse_args()
+
+    fixture = Fixture(options)
+    try:
+        fixture.create()
+        fixture.start()
+        test = LoadTest(fixture, options)
+        test.run()
+    finally:
+        if hasattr(fixture, 'daemon'):
+            fixture.stop()
+        elif not options.keep:
+            shutil.rmtree(fixture.workdir)
+    report(test)
+    if options.json:
+        json.dump(results(test), open(options.json, 'w'), indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] in (['--serve'], ['--worker']):
+        serve(sys.argv[1:])
+    else:
+        main()
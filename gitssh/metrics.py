@@ -0,0 +1,174 @@
+import functools
+import time
+from bisect import bisect_left
+from twisted.internet import defer
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+# Seconds, from a cached lookup to a slow clone
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1, 2.5, 5, 10, 30, 60, 300, 1800)
+# Bytes, from a ref advertisement to a large clone
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864,
+                268435456, 1073741824)
+
+def labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, value)
+                          for name, value in zip(names, values)) + "}"
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Label values: value
+        self.values = {}
+
+    def key(self, labelvalues):
+        return tuple(labelvalues[name] for name in self.labelnames)
+
+    def samples(self):
+        """Yield the name, labels and value of each sample."""
+        for key, value in sorted(self.values.iteritems()):
+            yield self.name, labels(self.labelnames, key), value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help),
+                 "# TYPE {0} {1}".format(self.name, self.type)]
+        for name, label, value in self.samples():
+            lines.append("{0}{1} {2}".format(name, label, value))
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labelvalues):
+        key = self.key(labelvalues)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labelvalues):
+        key = self.key(labelvalues)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labelvalues):
+        self.inc(-amount, **labelvalues)
+
+class Callback(Metric):
+    """A counter or gauge read from the objects it describes when the metrics
+    are collected, so it costs nothing in between. function returns a dict of
+    label values: value."""
+    def __init__(self, name, help, type, function, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.type = type
+        self.function = function
+
+    def samples(self):
+        for key, value in sorted(self.function().iteritems()):
+            yield self.name, labels(self.labelnames, key), value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labelvalues):
+        key = self.key(labelvalues)
+        counts = self.values.get(key)
+        if counts is None:
+            # A count for each bucket and +Inf, then the sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, start, **labelvalues):
+        self.observe(time.time() - start, **labelvalues)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for key, counts in sorted(self.values.iteritems()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield (self.name + "_bucket",
+                       labels(names, key + (bound,)), total)
+            yield self.name + "_count", labels(self.labelnames, key), total
+            yield self.name + "_sum", labels(self.labelnames, key), counts[-1]
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def callback(self, *args, **kwargs):
+        return self.register(Callback(*args, **kwargs))
+
+    def render(self):
+        """The metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def timed(histogram, **labelvalues):
+    """Decorate a function to observe how long it takes, until the Deferred
+    it returns fires if it returns one."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            result = function(*args, **kwargs)
+            if isinstance(result, defer.Deferred):
+                def observe(result):
+                    histogram.time(start, **labelvalues)
+                    return result
+                result.addBoth(observe)
+            else:
+                histogram.time(start, **labelvalues)
+            return result
+        return wrapper
+    return decorator
+
+class MetricsResource(Resource):
+    """Serve a registry to Prometheus."""
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+class MetricsSite(Site):
+    """Serve a registry over HTTP, without logging every scrape."""
+    noisy = False
+
+    def __init__(self, registry=registry):
+        Site.__init__(self, MetricsResource(registry))
+
+    def log(self, request):
+        pass
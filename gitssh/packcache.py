@@ -0,0 +1,419 @@
+import errno
+import hashlib
+import os
+import time
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import cooperate
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from gitssh.pktline import flush_end
+
+# Capabilities which do not change the response
+IGNORED_CAPABILITIES = ('agent=', 'session-id=')
+
+class PackCache(object):
+    """Responses of git-upload-pack to full clones, kept on disk.
+
+    A response is stored in a directory for its repository, named by a hash of
+    the ref advertisement and a hash of the request, so it is only used while
+    the refs are unchanged. When the refs of a repository are seen to change,
+    its older responses are removed. The files are shared by every process
+    using the same directory, and so is the budget: a file's mtime is set
+    when it is used, and after storing a response a process scans the whole
+    directory, removing the least recently used files until they take at
+    most max_size bytes."""
+    def __init__(self, directory, max_size, max_entry_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        # Bytes in the directory at the last scan
+        self.size = 0
+        # repository path: hash of its last seen ref advertisement
+        self.refs = {}
+        self.counter = 0
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """Pick up the files left by earlier runs."""
+        self.scan()
+
+    def scan(self):
+        """Remove the least recently used files while the directory is over
+        max_size."""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed by another process
+                    continue
+                if '.tmp' in name:
+                    # Left behind by a process which stopped while writing
+                    if stat.st_mtime < time.time() - 3600:
+                        self.unlink(path)
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        found.sort()
+        self.size = sum(size for mtime, path, size in found)
+        for mtime, path, size in found:
+            if self.size <= self.max_size:
+                break
+            self.unlink(path)
+            self.size -= size
+
+    def repository_directory(self, repopath):
+        return os.path.join(self.directory, hashlib.sha1(repopath).hexdigest())
+
+    def path(self, repopath, refs, request):
+        return os.path.join(self.repository_directory(repopath),
+                            "{0}-{1}.pack".format(refs, request))
+
+    def seen(self, repopath, refs):
+        """Remove the responses for older refs of a repository."""
+        if self.refs.get(repopath) == refs:
+            return
+        self.refs[repopath] = refs
+        directory = self.repository_directory(repopath)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(refs) and '.tmp' not in name:
+                self.unlink(os.path.join(directory, name))
+
+    def open(self, path):
+        """Return the cached response at path as an open file, or None."""
+        try:
+            packfile = open(path, 'rb')
+        except IOError:
+            # Never stored, or removed by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            # Most recently used, for every process
+            os.utime(path, None)
+        except OSError:
+            pass
+        return packfile
+
+    def create(self, path):
+        """Return a temporary file to record a response in, or None."""
+        self.counter += 1
+        temporary = "{0}.tmp.{1}.{2}".format(path, os.getpid(), self.counter)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            return temporary, open(temporary, 'wb')
+        except (IOError, OSError):
+            log.err(None, "Could not create {0}".format(temporary))
+            return None
+
+    def store(self, temporary, path, repopath, refs, size):
+        """Move a recorded response into place, unless the refs it was made
+        for have changed since."""
+        if self.refs.get(repopath) != refs:
+            self.unlink(temporary)
+            return
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            log.err(None, "Could not store {0}".format(path))
+            self.unlink(temporary)
+            return
+        self.scan()
+
+    def unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+class CachingUploadPack(ProcessProtocol):
+    """Run git-upload-pack for a session, answering full clones from a PackCache.
+
+    This sits between the process and the session's process protocol, and
+    is the transport the session writes the client's data to. The client's
+    request is held until it is known whether it is a full clone: wants,
+    a flush and done, with no haves, shallow or filter lines. Responses are
+    keyed by the process's ref advertisement, so a request which comes
+    before it, when the session was started from a RefCache, is held until
+    the advertisement is complete. A cached response to the same request
+    for the same refs is sent from the disk instead of the process's, and
+    the process is told the client wants nothing. Otherwise the request is
+    passed on, and the response to a full clone is recorded for the next
+    one. Any other request is passed on untouched."""
+    # Client data held before giving up on recognising the request
+    max_request = 1024 * 1024
+    chunk_size = 64 * 1024
+
+    def __init__(self, client, cache, repopath):
+        self.client = client
+        self.cache = cache
+        self.repopath = repopath
+        self.deciding = True
+        self.request = ""
+        # The process's ref advertisement, until its flush-pkt
+        self.advertisement = ""
+        # Hash of the advertisement, once it is complete
+        self.refs = None
+        self.recording = None
+        self.recorded = 0
+        self.streaming = None
+        self.paused = False
+        self.streamed = False
+        self.stopped = False
+        self.ended = None
+
+    # Process protocol
+
+    def connectionMade(self):
+        self.client.makeConnection(self)
+
+    def outReceived(self, data):
+        if self.advertisement is not None:
+            # Still the ref advertisement
+            self.advertisement += data
+            try:
+                end = flush_end(self.advertisement)
+            except ValueError:
+                # Not an advertisement
+                self.passthrough()
+                end = None
+            self.client.outReceived(data)
+            if end is not None:
+                self.refs = hashlib.sha1(self.advertisement[:end]).hexdigest()
+                self.advertisement = None
+                # The client's request may have come first, when the session
+                # was started from a cached advertisement
+                self.decide()
+            return
+        if self.streaming:
+            return
+        elif self.recording:
+            self.record(data)
+        self.client.outReceived(data)
+
+    def errReceived(self, data):
+        self.client.errReceived(data)
+
+    def inConnectionLost(self):
+        self.client.inConnectionLost()
+
+    def outConnectionLost(self):
+        if not self.streaming:
+            self.client.outConnectionLost()
+
+    def errConnectionLost(self):
+        self.client.errConnectionLost()
+
+    def processEnded(self, reason):
+        if self.recording:
+            temporary, packfile, path, refs = self.recording
+            self.recording = None
+            packfile.close()
+            if reason.check(ProcessDone):
+                self.cache.store(temporary, path, self.repopath, refs, self.recorded)
+            else:
+                self.cache.unlink(temporary)
+        if self.streaming:
+            self.ended = reason
+            self.finish()
+        else:
+            self.client.processEnded(reason)
+
+    # Transport for the session
+
+    def write(self, data):
+        if self.streaming:
+            return
+        if not self.deciding:
+            self.transport.write(data)
+            return
+        self.request += data
+        if len(self.request) > self.max_request:
+            self.passthrough()
+        elif self.advertisement is None:
+            self.decide()
+
+    def closeStdin(self):
+        if self.deciding:
+            self.passthrough()
+        if not self.streaming:
+            self.transport.closeStdin()
+
+    def signalProcess(self, signal):
+        self.stop()
+        self.transport.signalProcess(signal)
+
+    def loseConnection(self):
+        self.stop()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        if self.streaming:
+            if not (self.paused or self.streamed or self.stopped):
+                self.paused = True
+                self.streaming.pause()
+        else:
+            self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if self.streaming:
+            if self.paused:
+                self.paused = False
+                if not self.stopped:
+                    self.streaming.resume()
+        else:
+            self.transport.resumeProducing()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    # The request
+
+    def decide(self):
+        """Answer the request held from the cache, or pass it on, once it is
+        known whether it is a full clone."""
+        if not self.request:
+            return
+        try:
+            request = self.parse()
+        except ValueError:
+            self.passthrough()
+            return
+        if request is not None:
+            self.full_clone(*request)
+
+    def parse(self):
+        """Return the wants and capabilities of a full clone request, None if
+        more data is needed, or raise ValueError for any other request."""
+        wants = []
+        capabilities = []
+        flushed = False
+        position = 0
+        while True:
+            if len(self.request) < position + 4:
+                return None
+            length = int(self.request[position:position + 4], 16)
+            if length == 0:
+                line = None
+                position += 4
+            elif length < 4:
+                raise ValueError("Bad pkt-line length")
+            elif len(self.request) < position + length:
+                return None
+            else:
+                line = self.request[position + 4:position + length].rstrip("\n")
+                position += length
+            if not flushed:
+                if line is None:
+                    if not wants:
+                        raise ValueError("No wants")
+                    flushed = True
+                elif line.startswith("want "):
+                    words = line.split(" ")
+                    wants.append(words[1])
+                    if len(wants) == 1:
+                        capabilities = [word for word in words[2:]
+                                        if not word.startswith(IGNORED_CAPABILITIES)]
+                else:
+                    raise ValueError("Not a full clone")
+            elif line == "done" and position == len(self.request):
+                return wants, capabilities
+            else:
+                raise ValueError("Not a full clone")
+
+    def passthrough(self):
+        self.deciding = False
+        self.advertisement = None
+        request, self.request = self.request, ""
+        if request:
+            self.transport.write(request)
+
+    def full_clone(self, wants, capabilities):
+        self.deciding = False
+        refs = self.refs
+        request = hashlib.sha1(" ".join(sorted(wants) + [""] +
+                                        sorted(capabilities))).hexdigest()
+        self.cache.seen(self.repopath, refs)
+        path = self.cache.path(self.repopath, refs, request)
+        packfile = self.cache.open(path)
+        if packfile:
+            log.msg("Sending cached pack for {0}".format(self.repopath))
+            self.request = ""
+            # The process is told the client wants nothing, as ls-remote would
+            self.transport.write("0000")
+            self.transport.closeStdin()
+            self.stream(packfile)
+        else:
+            created = self.cache.create(path)
+            if created:
+                temporary, recordfile = created
+                self.recording = temporary, recordfile, path, refs
+            self.passthrough()
+
+    # Recording a response
+
+    def record(self, data):
+        temporary, packfile, path, refs = self.recording
+        self.recorded += len(data)
+        try:
+            if self.recorded > self.cache.max_entry_size:
+                raise IOError("Response is too large to cache")
+            packfile.write(data)
+        except IOError:
+            self.recording = None
+            packfile.close()
+            self.cache.unlink(temporary)
+
+    # Sending a cached response
+
+    def stream(self, packfile):
+        def chunks():
+            try:
+                while True:
+                    chunk = packfile.read(self.chunk_size)
+                    if not chunk:
+                        return
+                    self.client.outReceived(chunk)
+                    yield None
+            finally:
+                packfile.close()
+        self.streaming = cooperate(chunks())
+        self.streaming.whenDone().addCallbacks(self.streamDone, self.streamFailed)
+
+    def streamDone(self, ignored):
+        self.streamed = True
+        self.finish()
+
+    def streamFailed(self, fail):
+        if not self.stopped:
+            log.err(fail, "Could not send cached pack for {0}".format(self.repopath))
+        self.streamed = Failure(ProcessTerminated(1))
+        self.finish()
+
+    def stop(self):
+        if self.streaming and not self.streamed and not self.stopped:
+            self.stopped = True
+            self.streaming.stop()
+
+    def finish(self):
+        """End the session once the cached response is sent and the process
+        has exited."""
+        if not (self.streamed and self.ended):
+            return
+        self.client.outConnectionLost()
+        if isinstance(self.streamed, Failure):
+            self.client.processEnded(self.streamed)
+        else:
+            self.client.processEnded(Failure(ProcessDone(0)))
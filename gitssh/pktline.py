@@ -0,0 +1,22 @@
+"""Encoding of git pkt-lines, as used by the git pack protocols."""
+
+def format_git_error(message):
+    """Encode message as an ERR pkt-line, byte for byte as git-error prints it."""
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    line = "ERR " + message
+    return "{0:04x}{1}\n".format(len(line) + 4, line)
+
+def flush_end(data):
+    """Return the length of the pkt-lines at the start of data up to and
+    including the first flush-pkt, None if there is no flush-pkt yet, or
+    raise ValueError if they are not pkt-lines."""
+    position = 0
+    while len(data) >= position + 4:
+        length = int(data[position:position + 4], 16)
+        if length == 0:
+            return position + 4
+        elif length < 4:
+            raise ValueError("Bad pkt-line length")
+        position += length
+    return None
@@ -0,0 +1,273 @@
+import os
+import time
+from collections import OrderedDict
+from twisted.internet.error import ProcessDone, ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from gitssh.pktline import flush_end
+
+class RefCache(object):
+    """The ref advertisements git-upload-pack sent for each repository.
+
+    An advertisement is kept along with the state of the repository's refs
+    when it was sent: the mtimes of the repository directory and of each
+    directory under refs. git writes refs, packed-refs, HEAD and config to a
+    lock file which is renamed into place, and so changes one of those
+    mtimes whenever it changes the advertisement. The state is checked on
+    every lookup, which is a few stats, and also sees changes made on other
+    hosts. Advertisements taken within racy_seconds of a change to the refs
+    are not kept, as a further change may not have moved the mtimes. At most
+    max_size bytes are kept, least recently used are evicted first."""
+    racy_seconds = 2
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # repository path: (directories, mtimes, advertisement), least
+        # recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Fetches which wanted nothing, answered without a process
+        self.noops = 0
+
+    def directories(self, repopath):
+        """Return the directories whose mtimes are the state of the refs."""
+        directories = [repopath]
+        for dirpath, dirnames, filenames in os.walk(os.path.join(repopath, 'refs')):
+            directories.append(dirpath)
+        return directories
+
+    def mtimes(self, directories):
+        try:
+            return tuple(os.stat(directory).st_mtime for directory in directories)
+        except OSError:
+            return None
+
+    def get(self, repopath):
+        """Return the advertisement for the refs the repository has now, or
+        None."""
+        entry = self.entries.pop(repopath, None)
+        if entry:
+            directories, mtimes, advertisement = entry
+            if self.mtimes(directories) == mtimes:
+                self.entries[repopath] = entry
+                self.hits += 1
+                return advertisement
+            self.size -= len(advertisement)
+        self.misses += 1
+        return None
+
+    def state(self, repopath):
+        """Return the state of the refs, to be given to store with the
+        advertisement a process then sends."""
+        directories = self.directories(repopath)
+        return directories, self.mtimes(directories)
+
+    def store(self, repopath, state, advertisement):
+        """Keep an advertisement, if the refs have not changed since state
+        was taken, nor shortly before."""
+        directories, mtimes = state
+        if (not mtimes or self.mtimes(directories) != mtimes or
+                time.time() - max(mtimes) < self.racy_seconds or
+                len(advertisement) > self.max_size):
+            return
+        self.discard(repopath)
+        self.entries[repopath] = directories, mtimes, advertisement
+        self.size += len(advertisement)
+        while self.size > self.max_size:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, repopath):
+        entry = self.entries.pop(repopath, None)
+        if entry:
+            self.size -= len(entry[2])
+
+class AdvertisedUploadPack(ProcessProtocol):
+    """Run git-upload-pack for a session, sending the ref advertisement from
+    a RefCache, and answering fetches which want nothing without a process.
+
+    This sits between the process and the session's process protocol, and
+    is the transport the session writes the client's data to. With a cached
+    advertisement, it is sent at once, and the client's request held. A
+    flush-pkt alone means the client has every ref it wants, and the session
+    ends as git-upload-pack would have ended it. Any other request starts the
+    process, whose own advertisement is dropped, and is passed on to it.
+    Without a cached advertisement, the process is started at once, and its
+    advertisement is stored for the next session.
+
+    spawn is called with this protocol to start the process."""
+    def __init__(self, client, cache, repopath, spawn):
+        self.client = client
+        self.cache = cache
+        self.repopath = repopath
+        self.spawn = spawn
+        # The advertisement sent to the client, while the process's is dropped
+        self.advertised = None
+        # The state of the refs, while the process's advertisement is stored
+        self.state = None
+        # The process's advertisement, until its flush-pkt
+        self.advertisement = ""
+        # The client's data, held until it is known whether a process is needed
+        self.request = ""
+        self.stdinClosed = False
+        self.stopped = False
+        self.paused = False
+        self.producer = None
+
+    def start(self):
+        advertisement = self.cache.get(self.repopath)
+        if advertisement is None:
+            self.state = self.cache.state(self.repopath)
+            self.spawn(self)
+            return
+        self.advertised = advertisement
+        self.client.makeConnection(self)
+        self.client.outReceived(advertisement)
+
+    # Process protocol
+
+    def connectionMade(self):
+        if self.advertised is None:
+            self.client.makeConnection(self)
+            return
+        # Started for a request, after the session was
+        if self.producer:
+            self.transport.registerProducer(*self.producer)
+        if self.paused:
+            self.transport.pauseProducing()
+        self.transport.write(self.request)
+        self.request = ""
+        if self.stdinClosed:
+            self.transport.closeStdin()
+
+    def outReceived(self, data):
+        if self.state:
+            # Passed on as it is received, and stored once it is complete
+            self.advertisement += data
+            self.client.outReceived(data)
+            try:
+                end = flush_end(self.advertisement)
+            except ValueError:
+                # Not an advertisement
+                self.state = None
+                self.advertisement = ""
+                return
+            if end is not None:
+                self.cache.store(self.repopath, self.state, self.advertisement[:end])
+                self.state = None
+                self.advertisement = ""
+            return
+        if self.advertised is not None:
+            self.advertisement += data
+            try:
+                end = flush_end(self.advertisement)
+            except ValueError:
+                end = 0
+            if end is None:
+                return
+            if self.advertisement[:end] != self.advertised:
+                # The client may want refs the process no longer has
+                log.msg("Refs of {0} changed while it was fetched".format(self.repopath))
+                self.cache.discard(self.repopath)
+            data = self.advertisement[end:]
+            self.advertised = None
+            self.advertisement = ""
+        if data:
+            self.client.outReceived(data)
+
+    def errReceived(self, data):
+        self.client.errReceived(data)
+
+    def inConnectionLost(self):
+        self.client.inConnectionLost()
+
+    def outConnectionLost(self):
+        if self.advertised is not None and self.advertisement:
+            # Exited before its advertisement was complete, e.g. with an
+            # error for the client
+            self.client.outReceived(self.advertisement)
+        self.client.outConnectionLost()
+
+    def errConnectionLost(self):
+        self.client.errConnectionLost()
+
+    def processEnded(self, reason):
+        self.client.processEnded(reason)
+
+    # Transport for the session, which has no process until one is needed
+
+    def write(self, data):
+        if self.transport:
+            self.transport.write(data)
+            return
+        if self.stopped:
+            return
+        self.request += data
+        if len(self.request) < 4:
+            return
+        if self.request == "0000":
+            # The client has every ref it wants
+            self.cache.noops += 1
+            self.finish()
+        else:
+            self.spawn(self)
+
+    def closeStdin(self):
+        if self.transport:
+            self.transport.closeStdin()
+        elif self.stopped:
+            return
+        elif self.request:
+            self.stdinClosed = True
+            self.spawn(self)
+        else:
+            # Closed without a request, which git-upload-pack exits on
+            self.finish()
+
+    def signalProcess(self, signal):
+        if not self.transport:
+            raise ProcessExitedAlready()
+        self.transport.signalProcess(signal)
+
+    def loseConnection(self):
+        if self.transport:
+            self.transport.loseConnection()
+        else:
+            self.stopped = True
+
+    def registerProducer(self, producer, streaming):
+        if self.transport:
+            self.transport.registerProducer(producer, streaming)
+        else:
+            self.producer = producer, streaming
+
+    def unregisterProducer(self):
+        if self.transport:
+            self.transport.unregisterProducer()
+        else:
+            self.producer = None
+
+    def pauseProducing(self):
+        if self.transport:
+            self.transport.pauseProducing()
+        else:
+            self.paused = True
+
+    def resumeProducing(self):
+        if self.transport:
+            self.transport.resumeProducing()
+        else:
+            self.paused = False
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def finish(self):
+        """End the session without a process, as git-upload-pack exits when
+        the client wants nothing."""
+        self.stopped = True
+        self.client.outConnectionLost()
+        self.client.processEnded(Failure(ProcessDone(0)))
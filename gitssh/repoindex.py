@@ -0,0 +1,203 @@
+import os
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted.python import filepath, log
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # Not available on this platform, rely on rescans alone
+    inotify = None
+else:
+    class Notifier(inotify.INotify):
+        """An INotify which may be closed twice: at shutdown, the reactor
+        disconnects it after the factory has stopped the index."""
+        def connectionLost(self, reason):
+            if not self.disconnected:
+                inotify.INotify.connectionLost(self, reason)
+
+def scan(root):
+    """Walk root, and return the repositories (directories ending in .git)
+    under it, and the directories containing them."""
+    repositories = set()
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        directories.append(dirpath)
+        for name in list(dirnames):
+            if name.endswith('.git'):
+                # Never descend into a repository
+                dirnames.remove(name)
+                repositories.add(os.path.join(dirpath, name))
+    return repositories, directories
+
+class RepositoryIndex(object):
+    """The git repositories under a set of root directories, so that a
+    repository path can be checked without going to the disk.
+
+    The index is built in a thread at start, and again every rescan_interval
+    seconds. In between it is kept current with inotify where available.
+    inotify only sees changes made on this host, so a path missing from the
+    index is still checked on the disk before it is refused. That it is
+    missing is then kept for negative_ttl seconds, until inotify sees it
+    created, or until the next scan, so repeated requests for a path which
+    does not exist do not each stat it. At most max_missing such paths are
+    kept."""
+    max_missing = 10000
+
+    if inotify:
+        mask = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+
+    def __init__(self, roots, rescan_interval, negative_ttl=0, clock=reactor):
+        self.roots = [os.path.normpath(root) for root in set(roots)]
+        self.rescan_interval = rescan_interval
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        # path: time until which it is known not to be a repository
+        self.missing = {}
+        # None until the first scan is done
+        self.repositories = None
+        # Changes seen while a scan is running, applied again to its result
+        self.changes = None
+        self.notifier = None
+        self.watched = set()
+        self.watch_failed = False
+        self.loop = LoopingCall(self.rescan)
+        self.loop.clock = clock
+
+    def start(self):
+        if inotify:
+            try:
+                self.notifier = Notifier()
+                self.notifier.startReading()
+            except Exception:
+                log.err(None, "Could not start inotify, relying on rescans")
+                self.notifier = None
+        if self.rescan_interval > 0:
+            self.loop.start(self.rescan_interval, now=True)
+        else:
+            self.rescan()
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        if self.notifier:
+            self.notifier.loseConnection()
+            self.notifier = None
+        self.watched.clear()
+
+    def rescan(self):
+        def scan_roots():
+            repositories = set()
+            directories = []
+            for root in self.roots:
+                found, containing = scan(root)
+                repositories.update(found)
+                directories.extend(containing)
+            return repositories, directories
+        self.changes = []
+        d = threads.deferToThread(scan_roots)
+        d.addCallbacks(self._scanned, self._failed)
+        return d
+
+    def _scanned(self, result):
+        repositories, directories = result
+        changes, self.changes = self.changes, None
+        self.repositories = repositories
+        self.missing.clear()
+        for path, added in changes:
+            self._update(path, added)
+        for directory in directories:
+            self.watch(directory)
+        log.msg("Indexed {0} repositories".format(len(repositories)))
+
+    def _failed(self, fail):
+        # Swallow the failure so the loop keeps running
+        self.changes = None
+        log.err(fail, "Could not scan the repositories")
+
+    def watch(self, directory):
+        if not self.notifier or directory in self.watched:
+            return
+        try:
+            self.notifier.watch(filepath.FilePath(directory), mask=self.mask,
+                                callbacks=[self.notify])
+        except Exception:
+            # Most likely out of watches (fs.inotify.max_user_watches). The
+            # directory is left to the rescans, only the first one is logged.
+            if not self.watch_failed:
+                self.watch_failed = True
+                log.err(None, "Could not watch {0}".format(directory))
+            return
+        self.watched.add(directory)
+
+    def notify(self, ignored, path, mask):
+        if mask & inotify.IN_Q_OVERFLOW:
+            # Events were lost, start over unless a scan is running
+            if self.changes is None:
+                self.rescan()
+            return
+        if not mask & inotify.IN_ISDIR:
+            return
+        path = path.path
+        added = bool(mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO))
+        if self.changes is not None:
+            self.changes.append((path, added))
+        self._update(path, added)
+
+    def _update(self, path, added):
+        if added and self.missing:
+            prefix = path + os.sep
+            for missing in [missing for missing in self.missing
+                            if missing == path or missing.startswith(prefix)]:
+                del self.missing[missing]
+        if self.repositories is None:
+            return
+        if path.endswith('.git'):
+            if added:
+                self.repositories.add(path)
+            else:
+                self.repositories.discard(path)
+        elif added:
+            # A new directory, which may already hold repositories if it was
+            # moved here
+            d = threads.deferToThread(scan, path)
+            d.addCallbacks(self._merge, log.err)
+        else:
+            prefix = path + os.sep
+            self.repositories.difference_update(
+                [repository for repository in self.repositories
+                 if repository.startswith(prefix)])
+            self.watched.difference_update(
+                [directory for directory in self.watched
+                 if directory == path or directory.startswith(prefix)])
+
+    def _merge(self, result):
+        repositories, directories = result
+        if self.repositories is not None:
+            self.repositories.update(repositories)
+        for directory in directories:
+            self.watch(directory)
+
+    def indexed(self, path):
+        return any(path.startswith(root + os.sep) for root in self.roots)
+
+    def exists(self, path):
+        """Return whether path is a repository."""
+        path = os.path.normpath(path)
+        if self.repositories is not None and path in self.repositories:
+            return True
+        now = self.clock.seconds()
+        if self.missing.get(path, 0) > now:
+            return False
+        # Not indexed yet, or created on another host
+        if not os.path.exists(path):
+            if self.negative_ttl > 0:
+                if len(self.missing) >= self.max_missing:
+                    self.missing.clear()
+                self.missing[path] = now + self.negative_ttl
+            return False
+        self.missing.pop(path, None)
+        if self.repositories is not None and self.indexed(path):
+            self.repositories.add(path)
+        return True
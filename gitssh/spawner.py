@@ -0,0 +1,175 @@
+import itertools
+import os
+import signal
+import socket
+import sys
+from twisted.internet import reactor
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.process import Process, _BaseProcess
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+from gitssh import forkserver
+
+class SpawnedProcess(Process):
+    """A process started by the spawner. The daemon holds its pipes, and the
+    spawner reaps it and reports its exit status."""
+    def __init__(self, reactor, spawner, number, executable, args, environment, proto):
+        _BaseProcess.__init__(self, proto)
+        self.spawner = spawner
+        self.number = number
+        self.pipes = {}
+        # childFD: the end of its pipe the daemon keeps, or the process gets
+        ours = {}
+        theirs = {}
+        try:
+            for child_fd in 0, 1, 2:
+                read_fd, write_fd = os.pipe()
+                if child_fd == 0:
+                    ours[child_fd], theirs[child_fd] = write_fd, read_fd
+                else:
+                    ours[child_fd], theirs[child_fd] = read_fd, write_fd
+            forkserver.send_command(spawner.socket,
+                                    {"id": number, "executable": executable,
+                                     "args": list(args), "env": environment},
+                                    [theirs[child_fd] for child_fd in 0, 1, 2])
+        except:
+            for fd in ours.values():
+                os.close(fd)
+            raise
+        finally:
+            for fd in theirs.values():
+                os.close(fd)
+
+        self.proto = proto
+        self.pipes[0] = self.processWriterFactory(reactor, self, 0, ours[0],
+                                                  forceReadHack=True)
+        for child_fd in 1, 2:
+            self.pipes[child_fd] = self.processReaderFactory(reactor, self, child_fd,
+                                                             ours[child_fd])
+        try:
+            if self.proto is not None:
+                self.proto.makeConnection(self)
+        except:
+            log.err()
+
+    def reapProcess(self):
+        # The spawner reports the exit status
+        pass
+
+    def signalProcess(self, signalID):
+        if signalID in ('HUP', 'STOP', 'INT', 'KILL', 'TERM'):
+            signalID = getattr(signal, 'SIG{0}'.format(signalID))
+        if self.lostProcess:
+            raise ProcessExitedAlready()
+        self.spawner.signal(self.number, signalID)
+
+    def __repr__(self):
+        return "<{0} number={1} status={2}>".format(self.__class__.__name__,
+                                                    self.number, self.status)
+
+class SpawnerProtocol(ProcessProtocol):
+    """Read exit statuses from the spawner's stdout, and relay its log."""
+    def __init__(self, spawner):
+        self.spawner = spawner
+        self.buffer = ""
+        self.errors = ""
+
+    def outReceived(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            number, status = line.split()
+            self.spawner.exited(int(number), int(status))
+
+    def errReceived(self, data):
+        self.errors += data
+        while "\n" in self.errors:
+            line, self.errors = self.errors.split("\n", 1)
+            log.msg("spawner: {0}".format(line))
+
+    def processEnded(self, status):
+        self.spawner.spawnerEnded(self, status)
+
+class Spawner(object):
+    """Start git processes from the spawner helper in gitssh.forkserver,
+    rather than by forking the daemon.
+
+    The helper is a fresh, small Python process, so forking it for each
+    session does not copy the page tables of the daemon and its caches.
+    While the helper is not running, processes are spawned from the daemon
+    as before."""
+    # Seconds to wait before replacing a helper which exited
+    respawn_delay = 1
+
+    def __init__(self):
+        self.script = os.path.splitext(os.path.abspath(forkserver.__file__))[0] + '.py'
+        self.running = False
+        self.socket = None
+        self.protocol = None
+        self.numbers = itertools.count(1)
+        # number: SpawnedProcess, for the processes running
+        self.processes = {}
+
+    def start(self):
+        self.running = True
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.protocol = SpawnerProtocol(self)
+        try:
+            reactor.spawnProcess(self.protocol, sys.executable,
+                                 [sys.executable, self.script, '3'], env=os.environ,
+                                 childFDs={0:'w', 1:'r', 2:'r', 3:theirs.fileno()})
+        except:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        self.socket = ours
+        log.msg("Started the spawner (pid {0})".format(self.protocol.transport.pid))
+
+    def stop(self):
+        self.running = False
+        if self.socket:
+            # The helper exits once the socket is closed
+            self.socket.close()
+            self.socket = None
+
+    def spawnProcess(self, proto, executable, args, env):
+        """Start a process, as reactor.spawnProcess does with its stdin, stdout
+        and stderr connected to proto."""
+        if self.socket:
+            number = next(self.numbers)
+            try:
+                process = SpawnedProcess(reactor, self, number, executable, args, env, proto)
+            except (socket.error, OSError):
+                log.err(None, "Could not send a command to the spawner")
+            else:
+                self.processes[number] = process
+                return process
+        return reactor.spawnProcess(proto, executable, args, env=env)
+
+    def signal(self, number, signalID):
+        try:
+            forkserver.send_command(self.socket, {"id": number, "signal": signalID})
+        except (socket.error, AttributeError):
+            raise ProcessExitedAlready()
+
+    def exited(self, number, status):
+        process = self.processes.pop(number, None)
+        if process:
+            process.processEnded(status)
+
+    def spawnerEnded(self, protocol, status):
+        if protocol is not self.protocol:
+            return
+        log.msg("The spawner exited ({0})".format(status.value.exitCode))
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        # Processes it started are no longer reaped by it, and their exit
+        # status is lost. They are ended when their pipes are closed.
+        processes, self.processes = self.processes, {}
+        for process in processes.itervalues():
+            process.processEnded(255 << 8)
+        if self.running:
+            reactor.callLater(self.respawn_delay, self.start)
@@ -0,0 +1,129 @@
+import os
+import signal
+import socket
+import sys
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from config import config
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """Relay a worker's log to the master's, and tell the master when it exits.
+
+    Cache control commands are passed to the worker on its stdin."""
+    def __init__(self, master, number):
+        self.master = master
+        self.number = number
+        self.retired = False
+        self.buffer = ""
+
+    def errReceived(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            log.msg("worker {0}: {1}".format(self.number, line))
+
+    def sendLine(self, line):
+        self.transport.write(line + "\n")
+
+    def processEnded(self, status):
+        self.master.workerEnded(self, status)
+
+class WorkerMaster(Service):
+    """Pre-fork worker processes sharing one listening socket, and keep them running.
+
+    On SIGHUP a new set of workers is started, and the old workers are asked
+    to finish their sessions and exit."""
+    # Seconds to wait before replacing a worker which exited on its own
+    respawn_delay = 1
+
+    def __init__(self, port, interface, count, script):
+        self.port = port
+        self.interface = interface
+        self.count = count
+        self.script = script
+        self.family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+        self.socket = None
+        self.workers = []
+
+    def privilegedStartService(self):
+        Service.privilegedStartService(self)
+        self.socket = socket.socket(self.family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.interface, self.port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+
+    def startService(self):
+        if not self.socket:
+            self.privilegedStartService()
+        Service.startService(self)
+        for number in range(self.count):
+            self.spawn(number)
+        signal.signal(signal.SIGHUP,
+                      lambda *args: reactor.callFromThread(self.reload))
+
+    def stopService(self):
+        Service.stopService(self)
+        for worker in self.workers:
+            self.retire(worker)
+        self.socket.close()
+
+    def spawn(self, number):
+        worker = WorkerProcessProtocol(self, number)
+        args = [sys.executable, self.script,
+                '--worker', '3', str(self.family), str(number)]
+        env = dict(os.environ, DRUPALDAEMONS_CNF=config.path)
+        reactor.spawnProcess(worker, sys.executable, args, env=env,
+                             childFDs={0:'w', 1:'r', 2:'r', 3:self.socket.fileno()})
+        self.workers.append(worker)
+        log.msg("Started worker {0} (pid {1})".format(number, worker.transport.pid))
+
+    def retire(self, worker):
+        """Ask a worker to stop accepting connections, and exit once its
+        sessions are done."""
+        worker.retired = True
+        worker.transport.signalProcess('TERM')
+
+    def reload(self):
+        log.msg("Reloading workers")
+        old_workers = list(self.workers)
+        for number in range(self.count):
+            self.spawn(number)
+        for worker in old_workers:
+            self.retire(worker)
+
+    def workerEnded(self, worker, status):
+        self.workers.remove(worker)
+        log.msg("Worker {0} exited ({1})".format(worker.number, status.value.exitCode))
+        if self.running and not worker.retired:
+            reactor.callLater(self.respawn_delay, self.spawn, worker.number)
+
+    # The cache control socket is served by the master, and forwarded to
+    # every worker, each of which keeps its own cache.
+
+    def invalidate(self, key):
+        for worker in self.workers:
+            worker.sendLine("invalidate {0}".format(key))
+
+    def flush(self):
+        for worker in self.workers:
+            worker.sendLine("flush")
+
+def drain(port, factory, interval=1):
+    """Stop accepting connections, then stop the reactor once the factory's
+    open connections have all closed."""
+    if getattr(factory, 'draining', False):
+        return
+    factory.draining = True
+    port.stopListening()
+    def check():
+        if not factory.connections:
+            # Shutting down may take longer than interval
+            loop.stop()
+            reactor.stop()
+    loop = LoopingCall(check)
+    loop.start(interval)
@@ -1,4 +1,5 @@
 from twisted.internet import defer
+from twisted.python import log
 from zope.interface import Interface
 import json
 
@@ -26,17 +27,11 @@ class Service(object):
         self.protocol.deferred.addCallback(self.convert_bool)
 
     def convert_json(self, raw):
-        def intify(d):
-            for k, v in d.iteritems():
-                if type(v) == dict:
-                    d[k] = intify(v)
-                elif type(v) == unicode and v.isdigit():
-                    d[k] = int(v)
-            return d
-
+        """Decode a JSON response. Which fields are integers depends on the
+        command, so any conversion is left to the caller, as AuthData does
+        for vcs-auth-data."""
         try:
-            result = json.loads(raw)
-            return intify(result) if type(result) == dict else result
+            return json.loads(raw)
         except ValueError:
             log.err("Protocol {0}:{1} returned bad JSON.".format(self.protocol.__class__, self.protocol.command))
 
@@ -0,0 +1,127 @@
+import json
+from twisted.python import log
+
+# Fields of a vcs-auth-data response, and of its user records, which are
+# integers. PHP may send them as strings of digits.
+INTEGER_FIELDS = frozenset(["uid", "repo_id", "access", "global", "repo_group", "status"])
+
+def integer(value):
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return value
+
+# Marks a field missing from a User
+MISSING = object()
+
+class User(object):
+    """A user's record in a vcs-auth-data response, read like the dict it was
+    decoded from.
+
+    Responses are cached for each project, and a large project lists hundreds
+    of users, so the known fields are kept in one tuple rather than in a dict
+    for every record. Any other fields are kept in a dict of their own."""
+    FIELDS = ("uid", "name", "pass", "access", "global", "repo_id", "ssh_keys",
+              "branch_create", "branch_update", "branch_delete",
+              "tag_create", "tag_update", "tag_delete", "per_label")
+    # field: position in values
+    POSITIONS = dict((field, position) for position, field in enumerate(FIELDS))
+    INTEGERS = tuple(position for position, field in enumerate(FIELDS)
+                     if field in INTEGER_FIELDS)
+    DEFAULTS = (MISSING,) * len(FIELDS)
+    __slots__ = ("values", "extra")
+
+    def __init__(self, record):
+        values = map(record.get, self.FIELDS, self.DEFAULTS)
+        for position in self.INTEGERS:
+            value = values[position]
+            if value.__class__ is unicode and value.isdigit():
+                values[position] = int(value)
+        self.values = tuple(values)
+        self.extra = None
+        if len(record) > len(values) - values.count(MISSING):
+            self.extra = dict((key, value) for key, value in record.iteritems()
+                              if key not in self.POSITIONS)
+
+    def __getitem__(self, key):
+        position = self.POSITIONS.get(key)
+        if position is None:
+            if self.extra and key in self.extra:
+                return self.extra[key]
+        else:
+            value = self.values[position]
+            if value is not MISSING:
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for field, value in zip(self.FIELDS, self.values):
+            if value is not MISSING:
+                yield field, value
+        if self.extra:
+            for item in self.extra.iteritems():
+                yield item
+
+    def record(self):
+        """Return the record as a dict, as it was received."""
+        return dict(self.iteritems())
+
+class AuthData(dict):
+    """A vcs-auth-data response, with its users indexed by key fingerprint.
+
+    Only the fields known to be integers are converted, and the user records
+    are kept as User objects. The index is built once when the response is
+    parsed, and cached along with it, so mapping a fingerprint to a user is a
+    dict lookup."""
+    def __init__(self, data):
+        dict.__init__(self, data)
+        for key in INTEGER_FIELDS:
+            if key in self:
+                self[key] = integer(self[key])
+        self.fingerprints = {}
+        # uid: serialised handoff for that user's sessions
+        self.handoffs = {}
+        users = self.get("users")
+        if not isinstance(users, dict):
+            # PHP encodes an empty array as []
+            return
+        users = self["users"] = dict((name, User(user))
+                                     for name, user in users.iteritems()
+                                     if isinstance(user, dict))
+        for name, user in users.iteritems():
+            ssh_keys = user.get("ssh_keys")
+            if not isinstance(ssh_keys, dict):
+                continue
+            for fingerprint in ssh_keys.itervalues():
+                owner = self.fingerprints.setdefault(fingerprint, user)
+                if owner is not user:
+                    log.err("Key {0} is registered to both {1} and {2}, using {1}.".format(
+                            fingerprint, owner.get("name"), name))
+
+    def handoff(self, user):
+        """Return the auth data passed on to the git hooks for user, as JSON.
+
+        Only the user's own record is included along with the repository
+        fields, rather than every maintainer of the project. It is serialised
+        once for each user, for as long as this response is cached."""
+        uid = user["uid"]
+        if uid not in self.handoffs:
+            data = dict((key, value) for key, value in self.iteritems()
+                        if key != "users")
+            data["users"] = dict((name, record.record())
+                                 for name, record in self["users"].iteritems()
+                                 if record is user)
+            self.handoffs[uid] = json.dumps(data)
+        return self.handoffs[uid]
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python import log
+from twisted.python.failure import Failure
+
+class ResponseCache(object):
+    """LRU cache of service responses, each kept for ttl seconds.
+
+    Concurrent misses for the same key share a single request to the service.
+    A response is kept for up to max_stale seconds past its ttl, so that it
+    can still be used while the service is down: see get()."""
+    def __init__(self, ttl, max_size, max_stale=0, clock=reactor):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self.clock = clock
+        # key: (expires, value), least recently used first
+        self.entries = OrderedDict()
+        # key: [Deferred, ...] waiting on the request in flight
+        self.pending = {}
+        # Keys invalidated while their request was in flight
+        self.discard = set()
+        # Lookups answered from the cache, with a stale value or not, for
+        # the metrics
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key, fetch, max_stale=0):
+        """Return a Deferred firing with the value for key.
+
+        On a miss fetch() is called, and must return a Deferred or a value.
+        A value less than max_stale seconds past its ttl is returned at once,
+        and fetch() is called in the background to refresh it. If that fails
+        the stale value is kept, so it is used until max_stale runs out."""
+        entry = self._entry(key, max_stale)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock.seconds():
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._request(key, fetch)
+            return defer.succeed(value)
+        self.misses += 1
+        d = defer.Deferred()
+        self._request(key, fetch, d)
+        return d
+
+    def cached(self, key):
+        """Return the value for key if it is cached and fresh, or None."""
+        entry = self._entry(key, 0)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+    def _entry(self, key, max_stale):
+        """Return the entry for key if it expired less than max_stale seconds
+        ago, or None. Entries past the cache's max_stale are dropped, and the
+        others become the most recently used."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires = entry[0]
+        now = self.clock.seconds()
+        if expires + self.max_stale > now:
+            self.entries[key] = entry
+        if expires + min(max_stale, self.max_stale) > now:
+            return entry
+
+    def _request(self, key, fetch, waiter=None):
+        """Call fetch() for key, unless it is already in flight."""
+        if key in self.pending:
+            if waiter:
+                self.pending[key].append(waiter)
+            return
+        self.pending[key] = [waiter] if waiter else []
+        request = defer.maybeDeferred(fetch)
+        request.addBoth(self._fetched, key)
+
+    def _fetched(self, result, key):
+        waiters = self.pending.pop(key)
+        if isinstance(result, Failure) and not waiters:
+            # A refresh in the background, so the stale value stays
+            log.msg("Could not refresh the cached response for {0}: {1}".format(
+                    key, result.getErrorMessage()))
+        if key in self.discard:
+            self.discard.remove(key)
+        elif not isinstance(result, Failure) and result is not None:
+            self.set(key, result)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock.seconds() + self.ttl, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop key, including the result of any request in flight."""
+        self.entries.pop(key, None)
+        if key in self.pending:
+            self.discard.add(key)
+
+    def flush(self):
+        self.entries.clear()
+        self.discard.update(self.pending)
+
+class PolledResponse(object):
+    """Keep the latest response from a service, refreshed every interval seconds.
+
+    value is None until the first request succeeds, and keeps the last good
+    response when a later request fails."""
+    def __init__(self, fetch, interval, clock=reactor):
+        self.fetch = fetch
+        self.interval = interval
+        self.value = None
+        self.loop = LoopingCall(self.refresh)
+        self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.interval, now=True)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def refresh(self):
+        d = defer.maybeDeferred(self.fetch)
+        d.addCallbacks(self._update, self._failed)
+        return d
+
+    def _update(self, result):
+        if result is not None:
+            self.value = result
+
+    def _failed(self, fail):
+        # Swallow the failure so the loop keeps running
+        log.err(fail, "Could not refresh polled service response")
+
+class CacheControlProtocol(LineOnlyReceiver):
+    """Accept cache commands, one per line, on a local control socket.
+
+    invalidate <key>  Drop a single key, e.g. a project name
+    flush             Drop every key"""
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        parts = line.strip().split()
+        if len(parts) == 2 and parts[0] == 'invalidate':
+            self.factory.cache.invalidate(parts[1])
+            log.msg("Invalidated cached auth data for {0}".format(parts[1]))
+            self.sendLine('OK')
+        elif parts == ['flush']:
+            self.factory.cache.flush()
+            log.msg("Flushed cached auth data")
+            self.sendLine('OK')
+        else:
+            self.sendLine('ERR unknown command')
+
+class CacheControlFactory(Factory):
+    protocol = CacheControlProtocol
+
+    def __init__(self, cache):
+        self.cache = cache
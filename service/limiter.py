@@ -0,0 +1,198 @@
+from collections import deque
+from twisted.conch.error import ConchError
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.python.failure import Failure
+
+class BackendUnavailable(ConchError):
+    pass
+
+UNAVAILABLE = "This operation cannot be completed at this time.  The authentication service is not responding; please try again in a few minutes."
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class CircuitBreaker(object):
+    """Stop calling the auth service while most calls to it are failing.
+
+    While closed, the outcomes of the last window calls are kept, and once
+    at least threshold of them have failed the breaker opens. While open,
+    calls are refused for reset_timeout seconds. Then the breaker is half
+    open: up to probes calls are let through, and it closes again once all
+    of them succeed, or opens again as soon as one fails. A threshold of 0
+    never opens."""
+    def __init__(self, threshold, window, reset_timeout, probes, clock=reactor):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.clock = clock
+        self.state = CLOSED
+        # True for each call which succeeded, most recent last
+        self.outcomes = deque(maxlen=window)
+        self.opened = None
+        self.probing = 0
+        self.probed = 0
+
+    def refusing(self):
+        """Return whether calls are being refused outright."""
+        if self.state == OPEN:
+            return self.clock.seconds() < self.opened + self.reset_timeout
+        elif self.state == HALF_OPEN:
+            return self.probing >= self.probes
+        return False
+
+    def allow(self):
+        """Return the state a call is let through in, or None to refuse it."""
+        if self.refusing():
+            return None
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+            self.probing = 0
+            self.probed = 0
+            log.msg("Probing the auth service")
+        if self.state == HALF_OPEN:
+            self.probing += 1
+        return self.state
+
+    def success(self, state):
+        """Record a call let through in state which succeeded."""
+        if state != self.state:
+            # Started before the state changed, so it says nothing about it
+            return
+        if state == HALF_OPEN:
+            self.probed += 1
+            if self.probed >= self.probes:
+                self.close()
+        else:
+            self.outcomes.append(True)
+
+    def failure(self, state):
+        """Record a call let through in state which failed."""
+        if state != self.state:
+            return
+        if state == HALF_OPEN:
+            self.open()
+        elif self.threshold:
+            self.outcomes.append(False)
+            failed = self.outcomes.count(False)
+            if (len(self.outcomes) == self.outcomes.maxlen and
+                    failed >= self.threshold * len(self.outcomes)):
+                self.open()
+
+    def open(self):
+        log.msg("Auth service calls are failing, refusing them for {0} seconds".format(
+                self.reset_timeout))
+        self.state = OPEN
+        self.opened = self.clock.seconds()
+        self.outcomes.clear()
+
+    def close(self):
+        log.msg("Auth service calls are succeeding again")
+        self.state = CLOSED
+        self.outcomes.clear()
+
+class BackendCall(object):
+    """A call to the auth service, waiting or in flight."""
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.deferred = defer.Deferred()
+        self.timeout = None
+        # Time after which the caller is no longer waiting for it
+        self.deadline = None
+        # The breaker state the call was let through in, once it is running
+        self.state = None
+
+class BackendLimiter(object):
+    """Bound the calls in flight to the auth service, so that a slow backend
+    is not sent ever more drush processes or HTTP requests.
+
+    Up to limit calls run at once, and up to queue_size more wait their
+    turn. Each call fails after timeout seconds, from when it was made, and
+    the breaker decides whether calls are made at all. Calls which fail for
+    any of these reasons fail with BackendUnavailable. A call which times
+    out while running keeps its place among the limit until the backend
+    answers it, so the backend never has more than limit calls to work on.
+    A limit, queue_size or timeout of 0 is no limit."""
+    def __init__(self, limit, queue_size, timeout, breaker, clock=reactor):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.breaker = breaker
+        self.clock = clock
+        self.running = 0
+        self.queue = deque()
+        # Calls refused or timed out, for the metrics
+        self.refused = 0
+        self.timeouts = 0
+
+    def run(self, function, *args):
+        """Return a Deferred firing with the result of function(*args), which
+        must return a Deferred or a value, once there is room to call it."""
+        if self.breaker.refusing():
+            self.refused += 1
+            return defer.fail(BackendUnavailable(UNAVAILABLE))
+        if self.queue_size and len(self.queue) >= self.queue_size:
+            self.refused += 1
+            return defer.fail(BackendUnavailable(UNAVAILABLE))
+        call = BackendCall(function, args)
+        if self.timeout:
+            call.deadline = self.clock.seconds() + self.timeout
+            call.timeout = self.clock.callLater(self.timeout, self.timedOut, call)
+        self.queue.append(call)
+        self.dispatch()
+        return call.deferred
+
+    def dispatch(self):
+        while self.queue and (not self.limit or self.running < self.limit):
+            call = self.queue.popleft()
+            if call.deadline is not None and self.clock.seconds() >= call.deadline:
+                # Past its timeout, which has not run yet
+                self.timeouts += 1
+                self.fail(call, BackendUnavailable(UNAVAILABLE))
+                continue
+            call.state = self.breaker.allow()
+            if call.state is None:
+                self.refused += 1
+                self.fail(call, BackendUnavailable(UNAVAILABLE))
+                continue
+            self.running += 1
+            d = defer.maybeDeferred(call.function, *call.args)
+            d.addBoth(self.finished, call)
+
+    def finished(self, result, call):
+        self.running -= 1
+        if call.deferred.called:
+            # Timed out, and the caller has been answered
+            self.dispatch()
+            return None
+        if isinstance(result, Failure):
+            self.breaker.failure(call.state)
+            if not result.check(ConchError):
+                # e.g. the connection was refused, which the client is told
+                # as the service being unavailable
+                log.err(result, "Auth service call failed")
+                result = Failure(BackendUnavailable(UNAVAILABLE))
+            self.fail(call, result)
+        else:
+            self.breaker.success(call.state)
+            if call.timeout and call.timeout.active():
+                call.timeout.cancel()
+            call.deferred.callback(result)
+        self.dispatch()
+
+    def fail(self, call, reason):
+        if call.timeout and call.timeout.active():
+            call.timeout.cancel()
+        call.deferred.errback(reason)
+
+    def timedOut(self, call):
+        self.timeouts += 1
+        if call in self.queue:
+            self.queue.remove(call)
+        else:
+            # Given up on, though it is still running until the backend
+            # answers it
+            self.breaker.failure(call.state)
+        call.deferred.errback(BackendUnavailable(UNAVAILABLE))
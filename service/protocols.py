@@ -1,12 +1,20 @@
 from base64 import b64encode
-from config import config
+from collections import deque
+from config import config, option, shared_option
 from service import IServiceProtocol
+from service.limiter import BackendLimiter, CircuitBreaker
+from service.snapshot import Snapshot
 from twisted.conch.error import ConchError
 from twisted.internet import reactor, defer
-from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol, Protocol
+from twisted.internet.task import deferLater, LoopingCall
 from twisted.python import log
-from twisted.web.client import getPage
+from twisted.web.client import getPage, ResponseDone
 from twisted.web.error import Error
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+import json
 import urllib, urlparse
 from zope.interface import implements
 
@@ -15,7 +23,16 @@ if auth_protocol == "drush":
     # Load drush settings from drupaldaemons.cnf
     drush_webroot = config.get('drush-settings', 'webroot')
     drush_path = config.get('drush-settings', 'drushPath')
-elif auth_protocol == "http":
+elif auth_protocol == "drush-pool":
+    # Long lived drush workers share the drush settings
+    drush_webroot = config.get('drush-settings', 'webroot')
+    drush_path = config.get('drush-settings', 'drushPath')
+    drush_worker_command = option('drush-pool-settings', 'workerCommand', 'vcs-auth-worker')
+    drush_pool_size = option('drush-pool-settings', 'size', 4)
+    drush_pool_pipeline = option('drush-pool-settings', 'pipeline', 8)
+    drush_pool_max_requests = option('drush-pool-settings', 'maxRequests', 1000)
+    drush_pool_timeout = option('drush-pool-settings', 'timeout', 10)
+elif auth_protocol in ("http", "http-pool"):
     # Load http settings
     http_service_url = config.get('http-settings', 'serviceUrl')
     http_headers = {}
@@ -25,8 +42,29 @@ elif auth_protocol == "http":
     if config.has_option('http-settings', 'httpAuth'):
         http_auth = b64encode(config.get('http-settings', 'httpAuth'))
         http_headers["Authorization"] = "Basic " + http_auth
+    if auth_protocol == "http-pool":
+        # Persistent connections need Twisted 12.1 or later
+        from twisted.web.client import Agent, HTTPConnectionPool
+        http_max_connections = option('http-pool-settings', 'maxConnectionsPerHost', 10)
+        http_connect_timeout = option('http-pool-settings', 'connectTimeout', 5)
+        http_read_timeout = option('http-pool-settings', 'readTimeout', 10)
+        http_retries = option('http-pool-settings', 'retries', 2)
+        http_retry_delay = option('http-pool-settings', 'retryDelay', 0.5)
+elif auth_protocol == "snapshot":
+    # Answer from a local snapshot exported by Drupal
+    snapshot_path = config.get('snapshot-settings', 'path')
+    snapshot_reload_interval = option('snapshot-settings', 'reloadInterval', 5)
 else:
     raise Exception("No valid authServiceProtocol specified.")
+# Limits on the calls to drush or http, shared by every request, and with
+# workers divided between them
+backend_limit = shared_option('auth-service', 'limit', 20)
+backend_queue_size = shared_option('auth-service', 'queueSize', 200)
+backend_timeout = option('auth-service', 'timeout', 15)
+breaker_threshold = option('auth-service', 'breakerThreshold', 0.5)
+breaker_window = option('auth-service', 'breakerWindow', 20)
+breaker_reset_timeout = option('auth-service', 'breakerResetTimeout', 10)
+breaker_probes = option('auth-service', 'breakerProbes', 3)
 
 class DrushError(ConchError):
     pass
@@ -34,6 +72,9 @@ class DrushError(ConchError):
 class HTTPError(ConchError):
     pass
 
+class SnapshotError(ConchError):
+    pass
+
 class DrushProcessProtocol(ProcessProtocol):
     implements(IServiceProtocol)
     """Read string values from Drush"""
@@ -42,6 +83,8 @@ class DrushProcessProtocol(ProcessProtocol):
         self.raw_error = ""
         self.deferred = defer.Deferred()
         self.command = command
+        self.timeout = None
+        self.timed_out = False
 
     def outReceived(self, data):
         self.raw += data
@@ -53,6 +96,8 @@ class DrushProcessProtocol(ProcessProtocol):
         self.result = self.raw.strip()
 
     def processEnded(self, status):
+        if self.timeout and self.timeout.active():
+            self.timeout.cancel()
         if self.raw_error:
             log.err("Errors reported from drush:")
             for each in self.raw_error.split("\n"):
@@ -61,7 +106,9 @@ class DrushProcessProtocol(ProcessProtocol):
         if self.result and rc == 0:
             self.deferred.callback(self.result)
         else:
-            if rc == 0:
+            if self.timed_out:
+                err = DrushError("Drush timed out.")
+            elif rc == 0:
                 err = DrushError("Failed to read from drush.")
             else:
                 err = DrushError("Drush failed ({0})".format(rc))
@@ -74,6 +121,197 @@ class DrushProcessProtocol(ProcessProtocol):
         for a in args:
             exec_args += a.values()
         reactor.spawnProcess(self, drush_path, exec_args, env={"TERM":"dumb"})
+        if backend_timeout:
+            # The limiter gives up on the call then, but keeps its slot until
+            # the process has exited
+            self.timeout = reactor.callLater(backend_timeout, self.kill)
+        return self.deferred
+
+    def kill(self):
+        self.timed_out = True
+        try:
+            self.transport.signalProcess('KILL')
+        except (OSError, ProcessExitedAlready):
+            pass
+
+class DrushWorkerProtocol(ProcessProtocol):
+    """A long lived drush process answering one JSON request per line.
+
+    Requests are written to stdin as {"id":int, "command":str, "args":list}
+    and answered on stdout, in any order, as {"id":int, "result":str} or
+    {"id":int, "error":str}. The worker exits when stdin is closed."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = ""
+        self.pending = {}
+        self.served = 0
+        self.retiring = False
+
+    def outReceived(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            if line.strip():
+                self.lineReceived(line)
+
+    def errReceived(self, data):
+        log.err("Errors reported from drush worker:")
+        for each in data.rstrip().split("\n"):
+            log.err("  " + each)
+
+    def lineReceived(self, line):
+        try:
+            response = json.loads(line)
+            request_id = response["id"]
+        except (ValueError, KeyError, TypeError):
+            log.err("Drush worker returned bad JSON: {0}".format(line))
+            return
+        # Requests which timed out are no longer pending
+        request = self.pending.pop(request_id, None)
+        if request is None:
+            return
+        self.served += 1
+        if "error" in response:
+            request.fail(DrushError("Drush failed ({0})".format(response["error"])))
+        else:
+            request.succeed(response.get("result"))
+        self.pool.requestDone(self)
+
+    def send(self, request):
+        self.pending[request.id] = request
+        request.worker = self
+        line = json.dumps({"id":request.id,
+                           "command":request.command,
+                           "args":request.args})
+        self.transport.write(line + "\n")
+
+    def retire(self):
+        """Stop taking requests, and exit once the pending ones are answered."""
+        self.retiring = True
+        if not self.pending:
+            self.transport.closeStdin()
+
+    def kill(self):
+        self.retiring = True
+        try:
+            self.transport.signalProcess('KILL')
+        except (OSError, ProcessExitedAlready):
+            pass
+
+    def processEnded(self, status):
+        self.retiring = True
+        pending, self.pending = self.pending, {}
+        for request in pending.values():
+            request.fail(DrushError("Drush worker exited ({0})".format(status.value.exitCode)))
+        self.pool.workerEnded(self)
+
+class DrushWorkerRequest(object):
+    """A request waiting in the pool, or pending on a worker."""
+    def __init__(self, request_id, command, args):
+        self.id = request_id
+        self.command = command
+        self.args = args
+        self.deferred = defer.Deferred()
+        self.worker = None
+        self.timeout = None
+
+    def succeed(self, result):
+        if self.timeout.active():
+            self.timeout.cancel()
+        self.deferred.callback(result)
+
+    def fail(self, err):
+        if self.timeout.active():
+            self.timeout.cancel()
+        self.deferred.errback(err)
+
+class DrushWorkerPool(object):
+    """Dispatch requests over a pool of long lived drush workers.
+
+    Each worker has up to pipeline requests in flight, and is replaced after
+    max_requests responses or when it exits."""
+    def __init__(self, size, pipeline, max_requests, timeout):
+        self.size = size
+        self.pipeline = pipeline
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.workers = []
+        self.queue = deque()
+        self.next_id = 0
+
+    def request(self, command, args):
+        self.next_id += 1
+        request = DrushWorkerRequest(self.next_id, command, args)
+        request.timeout = reactor.callLater(self.timeout, self.timedOut, request)
+        self.queue.append(request)
+        self.dispatch()
+        return request.deferred
+
+    def spawn(self):
+        worker = DrushWorkerProtocol(self)
+        exec_args = [drush_path,
+                     "--root={0}".format(drush_webroot),
+                     drush_worker_command]
+        reactor.spawnProcess(worker, drush_path, exec_args, env={"TERM":"dumb"})
+        self.workers.append(worker)
+        return worker
+
+    def available(self):
+        """Return the least loaded worker able to take a request, if any."""
+        workers = [w for w in self.workers if not w.retiring]
+        while len(workers) < self.size:
+            workers.append(self.spawn())
+        workers = [w for w in workers
+                   if len(w.pending) < self.pipeline and
+                      w.served + len(w.pending) < self.max_requests]
+        if workers:
+            return min(workers, key=lambda w: len(w.pending))
+
+    def dispatch(self):
+        while self.queue:
+            worker = self.available()
+            if not worker:
+                break
+            worker.send(self.queue.popleft())
+
+    def timedOut(self, request):
+        if request.worker:
+            # The worker may be stuck, so replace it
+            del request.worker.pending[request.id]
+            request.worker.kill()
+        else:
+            self.queue.remove(request)
+        request.deferred.errback(DrushError("Drush worker timed out."))
+
+    def requestDone(self, worker):
+        if worker.served >= self.max_requests or worker.retiring:
+            worker.retire()
+        self.dispatch()
+
+    def workerEnded(self, worker):
+        self.workers.remove(worker)
+        self.dispatch()
+
+class DrushPoolProtocol(object):
+    implements(IServiceProtocol)
+    """Read string values from a pooled drush worker"""
+    def __init__(self, command):
+        self.deferred = defer.Deferred()
+        self.command = command
+
+    def read_result(self, result):
+        result = (result or "").strip()
+        if not result:
+            raise DrushError("Failed to read from drush.")
+        return result
+
+    def request(self, *args):
+        arguments = []
+        for a in args:
+            arguments += a.values()
+        d = drush_pool.request(self.command, arguments)
+        d.addCallback(self.read_result)
+        d.chainDeferred(self.deferred)
         return self.deferred
 
 class HTTPServiceProtocol(object):
@@ -92,11 +330,208 @@ class HTTPServiceProtocol(object):
             arguments.update(a)
         url_arguments = self.command + "?" + urllib.urlencode(arguments)
         constructed_url = urlparse.urljoin(http_service_url, url_arguments)
-        self.deferred = getPage(constructed_url, headers=http_headers)
+        # Bounded by the limiter's timeout, as the call keeps its slot until
+        # the request is done
+        self.deferred = getPage(constructed_url, headers=http_headers,
+                                timeout=backend_timeout)
         self.deferred.addErrback(self.http_request_error)
 
 
+class HTTPBodyProtocol(Protocol):
+    """Collect a response body, firing deferred with it once complete."""
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            # The request was cancelled
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.callback("".join(self.data))
+        else:
+            self.deferred.errback(reason)
+
+class HTTPConnectionPoolClient(object):
+    """GET urls over persistent connections to the auth service.
+
+    Failed requests are retried with an exponential backoff, except for 4xx
+    responses which are not expected to change."""
+    def __init__(self, max_connections, connect_timeout, read_timeout, retries, retry_delay):
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_connections
+        self.agent = Agent(reactor, connectTimeout=connect_timeout, pool=self.pool)
+        # All requests go to the one host, so this bounds open connections
+        self.connections = defer.DeferredSemaphore(max_connections)
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.headers = Headers(dict((k, [v]) for k, v in http_headers.items()))
+
+    def get(self, url, attempt=0):
+        d = self.connections.run(self.fetch, url)
+        def retry(fail):
+            if attempt >= self.retries or fail.check(Error) and int(fail.value.status) < 500:
+                return fail
+            delay = self.retry_delay * 2 ** attempt
+            return deferLater(reactor, delay, self.get, url, attempt + 1)
+        d.addErrback(retry)
+        return d
+
+    def fetch(self, url):
+        d = self.agent.request('GET', url, self.headers)
+        d.addCallback(self.read_response)
+        timeout = reactor.callLater(self.read_timeout, d.cancel)
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        d.addBoth(cancel_timeout)
+        return d
+
+    def read_response(self, response):
+        # Always read the body, so the connection can go back to the pool
+        body = defer.Deferred(lambda d: protocol.transport.stopProducing())
+        protocol = HTTPBodyProtocol(body)
+        response.deliverBody(protocol)
+        def check_status(data):
+            if response.code >= 400:
+                raise Error(response.code, response.phrase)
+            return data
+        body.addCallback(check_status)
+        return body
+
+class HTTPPoolServiceProtocol(object):
+    implements(IServiceProtocol)
+    def __init__(self, url):
+        self.deferred = None
+        self.command = url
+
+    def http_request_error(self, fail):
+        log.err(fail, "Request for {0} failed".format(self.command))
+        raise HTTPError("Could not open URL for {0}.".format(self.command))
+
+    def request(self, *args):
+        arguments = dict()
+        for a in args:
+            arguments.update(a)
+        url_arguments = self.command + "?" + urllib.urlencode(arguments)
+        constructed_url = urlparse.urljoin(http_service_url, url_arguments)
+        self.deferred = http_client.get(constructed_url)
+        self.deferred.addErrback(self.http_request_error)
+
+class LimitedProtocol(object):
+    implements(IServiceProtocol)
+    """Make requests with BackendProtocol, through the backend limiter."""
+    def __init__(self, command):
+        self.protocol = BackendProtocol(command)
+        self.command = command
+        self.deferred = defer.Deferred()
+
+    def call(self, args):
+        self.protocol.request(*args)
+        return self.protocol.deferred
+
+    def request(self, *args):
+        d = backend_limiter.run(self.call, args)
+        d.chainDeferred(self.deferred)
+        return self.deferred
+
+class SnapshotLoader(object):
+    """Keep the latest auth snapshot open.
+
+    Every interval seconds the file is checked, and if it has been replaced
+    the new snapshot is loaded and swapped in whole. A snapshot which cannot
+    be read is logged, and the previous one kept."""
+    def __init__(self, path, interval):
+        self.path = path
+        self.snapshot = None
+        self.loop = LoopingCall(self.reload)
+        self.interval = interval
+
+    def start(self):
+        self.loop.start(self.interval, now=True)
+
+    def reload(self):
+        if self.snapshot and not self.snapshot.changed(self.path):
+            return
+        try:
+            snapshot = Snapshot(self.path)
+        except Exception:
+            log.err(None, "Could not load the auth snapshot {0}".format(self.path))
+            return
+        old, self.snapshot = self.snapshot, snapshot
+        log.msg("Loaded the auth snapshot {0}, {1} projects and {2} users".format(
+                self.path, len(snapshot.projects), len(snapshot.users)))
+        if old:
+            old.close()
+
+class SnapshotProtocol(object):
+    implements(IServiceProtocol)
+    """Answer requests from the local auth snapshot, with the strings the
+    drush commands would return."""
+    def __init__(self, command):
+        self.deferred = None
+        self.command = command
+
+    def request(self, *args):
+        arguments = dict()
+        for a in args:
+            arguments.update(a)
+        self.deferred = defer.maybeDeferred(self.lookup, arguments)
+
+    def lookup(self, arguments):
+        snapshot = snapshot_loader.snapshot
+        if not snapshot:
+            raise SnapshotError("The auth snapshot is not available.")
+        if self.command == 'vcs-auth-data':
+            auth_data = snapshot.project(arguments["project_uri"])
+            if auth_data is None:
+                raise SnapshotError("No auth data for {0} in the snapshot.".format(
+                                    arguments["project_uri"]))
+            return auth_data
+        elif self.command == 'pushctl-state':
+            return snapshot.pushctl
+        elif self.command == 'drupalorg-ssh-user-key':
+            matches = snapshot.user_key(arguments["username"], arguments["fingerprint"])
+            return "true" if matches else "false"
+        elif self.command == 'drupalorg-vcs-auth-fetch-user-hash':
+            stored_hash = snapshot.user_hash(arguments["username"])
+            return json.dumps(stored_hash) if stored_hash else "false"
+        elif self.command == 'drupalorg-vcs-auth-check-user-pass':
+            stored_hash = snapshot.user_hash(arguments["username"])
+            return "true" if stored_hash and stored_hash == arguments["password"] else "false"
+        else:
+            raise SnapshotError("The snapshot cannot answer {0}.".format(self.command))
+
+backend_limiter = None
 if auth_protocol == "drush":
-    AuthProtocol = DrushProcessProtocol
+    BackendProtocol = DrushProcessProtocol
+elif auth_protocol == "drush-pool":
+    drush_pool = DrushWorkerPool(drush_pool_size,
+                                 drush_pool_pipeline,
+                                 drush_pool_max_requests,
+                                 drush_pool_timeout)
+    BackendProtocol = DrushPoolProtocol
 elif auth_protocol == "http":
-    AuthProtocol = HTTPServiceProtocol
+    BackendProtocol = HTTPServiceProtocol
+elif auth_protocol == "http-pool":
+    http_client = HTTPConnectionPoolClient(http_max_connections,
+                                           http_connect_timeout,
+                                           http_read_timeout,
+                                           http_retries,
+                                           http_retry_delay)
+    BackendProtocol = HTTPPoolServiceProtocol
+if auth_protocol == "snapshot":
+    # Answered locally, so there is nothing to protect
+    snapshot_loader = SnapshotLoader(snapshot_path, snapshot_reload_interval)
+    snapshot_loader.start()
+    AuthProtocol = SnapshotProtocol
+else:
+    backend_limiter = BackendLimiter(backend_limit, backend_queue_size, backend_timeout,
+                                     CircuitBreaker(breaker_threshold, breaker_window,
+                                                    breaker_reset_timeout, breaker_probes))
+    AuthProtocol = LimitedProtocol
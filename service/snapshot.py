@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Auth data exported from Drupal into a local file, so that git keeps working
+without it.
+
+A snapshot is the magic string, the length of the index as 8 big endian bytes,
+the index as JSON, then the records. The index is:
+
+    {"created": unix time,
+     "pushctl": push control state, as pushctl-state returns it,
+     "projects": {project name: [offset, length]},
+     "users": {username: [offset, length]},
+     "fingerprints": {fingerprint: [username, ...]}}
+
+Offsets count from the start of the records. A project's record is the JSON
+vcs-auth-data returns for it, and a user's record is {"pass": stored hash}.
+
+Build a snapshot from a JSON export with:
+python -m service.snapshot export.json auth.snapshot [group]
+
+The snapshot holds password hashes, so it is only readable by its owner, or
+also by group if one is given (the group the daemon runs as).
+
+The export is {"pushctl": int, "projects": {name: vcs-auth-data},
+"users": {username: {"pass": stored hash, "ssh_keys": {name: fingerprint}}}}"""
+import grp
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+MAGIC = "DGSNAP1\n"
+HEADER = struct.Struct(">Q")
+
+class SnapshotFormatError(Exception):
+    pass
+
+class Snapshot(object):
+    """An open snapshot. Records are read from the memory mapped file as
+    they are asked for."""
+    def __init__(self, path):
+        snapshot_file = open(path, 'rb')
+        try:
+            self.stat = os.fstat(snapshot_file.fileno())
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            snapshot_file.close()
+        header_size = len(MAGIC) + HEADER.size
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise SnapshotFormatError("{0} is not an auth snapshot".format(path))
+        index_size, = HEADER.unpack(self.map[len(MAGIC):header_size])
+        self.records = header_size + index_size
+        try:
+            index = json.loads(self.map[header_size:self.records])
+        except ValueError:
+            raise SnapshotFormatError("{0} has a bad index".format(path))
+        self.created = index["created"]
+        self.pushctl = index["pushctl"]
+        self.projects = index["projects"]
+        self.users = index["users"]
+        self.fingerprints = index["fingerprints"]
+
+    def record(self, index, key):
+        location = index.get(key)
+        if location is None:
+            return None
+        offset, length = location
+        start = self.records + offset
+        return self.map[start:start + length]
+
+    def project(self, name):
+        """Return the raw vcs-auth-data JSON for a project, or None."""
+        return self.record(self.projects, name)
+
+    def user_hash(self, username):
+        """Return the stored password hash of a user, or None."""
+        user = self.record(self.users, username)
+        if user is not None:
+            return json.loads(user)["pass"]
+
+    def user_key(self, username, fingerprint):
+        """Return whether the key is one of the user's."""
+        return username in self.fingerprints.get(fingerprint, ())
+
+    def changed(self, path):
+        """Return whether path is no longer the file this snapshot was read from."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return ((stat.st_ino, stat.st_mtime, stat.st_size) !=
+                (self.stat.st_ino, self.stat.st_mtime, self.stat.st_size))
+
+    def close(self):
+        self.map.close()
+
+def write_snapshot(path, projects, users, pushctl, group=None):
+    """Write a snapshot, replacing any existing one in one step.
+
+    projects maps names to vcs-auth-data, users maps usernames to
+    {"pass": stored hash, "ssh_keys": {name: fingerprint}}. The file is mode
+    0600, or 0640 and owned by group if one is given."""
+    records = []
+    size = 0
+    index = {"created": int(time.time()), "pushctl": str(pushctl),
+             "projects": {}, "users": {}, "fingerprints": {}}
+    def add(section, key, value):
+        data = json.dumps(value, separators=(',', ':'))
+        index[section][key] = [size, len(data)]
+        records.append(data)
+        return len(data)
+    for name, auth_data in sorted(projects.iteritems()):
+        size += add("projects", name, auth_data)
+    for username, user in sorted(users.iteritems()):
+        size += add("users", username, {"pass": user.get("pass")})
+        for fingerprint in (user.get("ssh_keys") or {}).itervalues():
+            index["fingerprints"].setdefault(fingerprint, []).append(username)
+    index_data = json.dumps(index, separators=(',', ':'))
+
+    directory, name = os.path.split(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(prefix=name + '.', dir=directory)
+    try:
+        snapshot_file = os.fdopen(descriptor, 'wb')
+        snapshot_file.write(MAGIC)
+        snapshot_file.write(HEADER.pack(len(index_data)))
+        snapshot_file.write(index_data)
+        for record in records:
+            snapshot_file.write(record)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+        snapshot_file.close()
+        if group is not None:
+            os.chown(temporary, -1, grp.getgrnam(group).gr_gid)
+            os.chmod(temporary, 0640)
+        os.rename(temporary, path)
+    except:
+        os.unlink(temporary)
+        raise
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        sys.exit("usage: python -m service.snapshot export.json auth.snapshot [group]")
+    export = json.load(open(sys.argv[1]))
+    write_snapshot(sys.argv[2], export["projects"], export["users"],
+                   export.get("pushctl", 0), *sys.argv[3:])
@@ -1,4 +1,4 @@
-%{!?python_sitelib: %define python_sitelib %(%{__python}26 -c "from distutils.sysconfig import get_python_lib; print get_python_lib(1)")}
+%{!?python_sitelib: %define python_sitelib %(%{__python}27 -c "from distutils.sysconfig import get_python_lib; print get_python_lib(1)")}
 
 Summary:    A TCP server for drupalGitSSHDaemon
 Name:       twisted-drupalGitSSHDaemon
@@ -9,7 +9,7 @@ Group:      Networking/Daemons
 Source:     twisted-drupalGitSSHDaemon-%{version}.tar.bz2
 BuildRoot:  %{_tmppath}/%{name}-%{version}-root
 BuildArch:  noarch
-Requires:   python26-twisted, pycrypto26
+Requires:   python27, python27-twisted >= 12.1, pycrypto27
 Requires(post): /sbin/chkconfig, openssh
 Requires(preun): /sbin/chkconfig, /sbin/service
 
@@ -40,6 +40,7 @@ cp "twisted-drupalGitSSHDaemon.init" "$RPM_BUILD_ROOT"%{_initrddir}/"twisted-dru
 %post
 if [ $1 -eq 1 ]; then
   /usr/bin/ssh-keygen -t rsa -f /etc/twisted-keys/default -P "" >/dev/null 2>&1 || :
+  /usr/bin/ssh-keygen -t ecdsa -b 256 -f /etc/twisted-keys/ecdsa -P "" >/dev/null 2>&1 || :
   /sbin/chkconfig --add twisted-drupalGitSSHDaemon
 fi
 